@@ -0,0 +1,216 @@
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+import openai
+import requests
+from jobs import JobCancelled, raise_if_cancelled
+
+# Deadlines, retries and hedging for the OpenAI API calls, with latency statistics per endpoint.
+# Every call goes through call_api, which gives each attempt a timeout, retries transient failures
+# with jittered exponential backoff (or after the server's Retry-After), and for idempotent calls
+# can send a duplicate request once the first one is slower than the endpoint's p95 latency.
+# The OpenAI clients are created with max_retries=0 so they do not retry on top of this.
+
+# Seconds allowed for a single attempt, per endpoint
+TIMEOUTS = {
+    'chat': 120.0,
+    # Batched prompt generation returns up to a few thousand tokens, so it is slower than a single chat call
+    'chat_batch': 180.0,
+    'embeddings': 30.0,
+    'images': 120.0,
+    'image_download': 60.0,
+}
+DEFAULT_TIMEOUT = 60.0
+MAX_ATTEMPTS = 4
+# Backoff before retry n is uniform in [0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** n)]
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 20.0
+# Longest Retry-After honoured before the call gives up on waiting
+MAX_RETRY_AFTER = 60.0
+RETRYABLE_STATUS = {408, 409, 429}
+
+# Hedging sends a second copy of an idempotent request once the first is slower than the endpoint's
+# HEDGE_PERCENTILE latency. It is off by default since it can double the cost of slow requests.
+HEDGE_REQUESTS = os.getenv('OPENAI_HEDGE_REQUESTS', '0') == '1'
+HEDGE_PERCENTILE = 95
+# Latency samples needed before an endpoint's percentile is trusted for hedging
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WORKERS = 8
+# Latencies kept per endpoint for the statistics
+LATENCY_WINDOW = 500
+
+
+class LatencyStats:
+    """
+    Recent attempt latencies and call outcomes per endpoint. Safe to use from several threads.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def record(self, endpoint, latency):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+
+    def count(self, endpoint, event):
+        with self.lock:
+            self.counts[endpoint][event] += 1
+
+    def percentile(self, endpoint, q):
+        """
+        Returns the q-th percentile latency of the endpoint, or None with fewer than HEDGE_MIN_SAMPLES samples.
+        """
+        with self.lock:
+            samples = sorted(self.latencies[endpoint])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+    def stats(self):
+        with self.lock:
+            endpoints = set(self.latencies) | set(self.counts)
+            summary = {}
+            for endpoint in sorted(endpoints):
+                samples = sorted(self.latencies[endpoint])
+                entry = dict(self.counts[endpoint])
+                entry['samples'] = len(samples)
+                if samples:
+                    for q in (50, 95, 99):
+                        entry[f'p{q}'] = samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+                    entry['max'] = samples[-1]
+                summary[endpoint] = entry
+            return summary
+
+
+latency_stats = LatencyStats()
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+
+
+def status_code(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+
+def is_retryable(error):
+    # Timeouts, dropped connections, rate limits and server errors are worth another attempt
+    if isinstance(error, (openai.APIConnectionError, requests.ConnectionError, requests.Timeout)):
+        return True
+    status = status_code(error)
+    return status is not None and (status in RETRYABLE_STATUS or status >= 500)
+
+
+def retry_after(error):
+    """
+    Returns the delay in seconds requested by the server's retry-after-ms or Retry-After header, or None.
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error):
+    delay = retry_after(error)
+    if delay is not None:
+        return delay
+    return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt))
+
+
+def timed_attempt(endpoint, request, timeout):
+    # Failed attempts are recorded too, so timeouts raise the percentiles instead of vanishing from them
+    start = time.perf_counter()
+    try:
+        return request(timeout)
+    finally:
+        latency_stats.record(endpoint, time.perf_counter() - start)
+
+
+def hedged_attempt(endpoint, request, timeout, threshold):
+    """
+    Run the request, and send a duplicate if it has not answered within `threshold` seconds.
+    Returns whichever succeeds first; the slower copy is left to finish and its response is discarded.
+    """
+    primary = hedge_executor.submit(timed_attempt, endpoint, request, timeout)
+    futures = [primary]
+    done, _ = wait(futures, timeout=threshold)
+    if not done:
+        latency_stats.count(endpoint, 'hedges')
+        futures.append(hedge_executor.submit(timed_attempt, endpoint, request, timeout))
+
+    error = None
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            futures.remove(future)
+            if future.exception() is None:
+                if future is not primary:
+                    latency_stats.count(endpoint, 'hedge_wins')
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call_api(endpoint, request, timeout=None, idempotent=False, hedge=None, cancel_token=None):
+    """
+    Call `request(timeout)` with a deadline per attempt and retries on transient errors.
+
+    Parameters:
+    - endpoint: Name the latency statistics and timeout are kept under ('chat', 'embeddings', 'images', ...).
+    - request: Function sending the request, given the timeout of the attempt in seconds.
+    - timeout: Seconds allowed per attempt, TIMEOUTS[endpoint] by default.
+    - idempotent: Whether a duplicate request is harmless, which hedging requires.
+    - hedge: Whether to hedge slow attempts, HEDGE_REQUESTS by default.
+    - cancel_token: CancelToken of the job making the call. No attempt is started once it is cancelled,
+      and a backoff is cut short, so a cancelled job does not hold its worker through the retries.
+
+    Returns:
+    - The response of the first successful attempt. The last error is raised once the attempts run out
+      or the error is not transient, and JobCancelled once the job is cancelled.
+    """
+    timeout = timeout or TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+    hedge = HEDGE_REQUESTS if hedge is None else hedge
+    latency_stats.count(endpoint, 'calls')
+
+    for attempt in range(MAX_ATTEMPTS):
+        raise_if_cancelled(cancel_token)
+        threshold = latency_stats.percentile(endpoint, HEDGE_PERCENTILE) if hedge and idempotent else None
+        try:
+            if threshold is None:
+                return timed_attempt(endpoint, request, timeout)
+            return hedged_attempt(endpoint, request, timeout, threshold)
+        except Exception as e:
+            if isinstance(e, (openai.APITimeoutError, requests.Timeout)):
+                latency_stats.count(endpoint, 'timeouts')
+            delay = backoff_delay(attempt, e) if is_retryable(e) else None
+            if delay is None or delay > MAX_RETRY_AFTER or attempt == MAX_ATTEMPTS - 1:
+                latency_stats.count(endpoint, 'errors')
+                raise
+            latency_stats.count(endpoint, 'retries')
+            print(f"Retrying {endpoint} request in {delay:.1f}s after error: {e}")
+            if cancel_token is None:
+                time.sleep(delay)
+            elif cancel_token.wait(delay):
+                raise JobCancelled()
+
+
+def api_stats():
+    return latency_stats.stats()
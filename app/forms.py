@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import FileField, SubmitField
+from wtforms import FileField, SelectField, SubmitField
 from wtforms.validators import DataRequired, Regexp
 from flask_wtf.file import FileAllowed, FileRequired
 
@@ -8,4 +8,8 @@ class PDFUploadForm(FlaskForm):
         FileRequired(message="Please select a file."),
         FileAllowed(['pdf', 'docx'], 'Only PDF or DOCX files are allowed.'),
     ])
+    extraction_backend = SelectField('Text Extraction', choices=[
+        ('markdown', 'Detailed (slower)'),
+        ('text', 'Plain text (faster)'),
+    ], default='markdown')
     submit = SubmitField('Submit')
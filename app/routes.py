@@ -2,56 +2,108 @@ from flask import Blueprint, render_template, request, redirect, send_file, json
 from app.forms import PDFUploadForm
 from app.summariser import summarise
 from generate_images import generate_images_from_prompts  # Import your function
-from generate_images import generate_images_from_prompts
-from pdf_generation import compile_info_for_pdf, update_text, caller
+from generate_images import generate_images_from_prompts, image_cache, image_library, prefetch_image, image_dir as section_image_dir
+from pdf_generation import layout_stats, DocumentBuilds, BODY_FONT_SIZE
+from document_model import EasyReadDocument
 from word_generation import create_docx
 from word2pdf import convert_to_pdf
+from jobs import CancelToken, JobCancelled
+from api_calls import api_stats
+from artifacts import artifact_hash, prune_artifacts, publish_file, IMMUTABLE_MAX_AGE
 
 import os
 import time
 import threading
+from io import BytesIO
 
 
 index_bp = Blueprint('index', __name__)
 
-UPLOAD_PROGRESS = {"progress": 0}
-
-def process_pdf(pdf_file_path):
-    global UPLOAD_PROGRESS, results, generated_images, docx_results
-
-    # Simulate progress updates
-    UPLOAD_PROGRESS['progress'] = 10
-    time.sleep(2.5)  # Simulate processing time
-
-    UPLOAD_PROGRESS['progress'] = 20
-    time.sleep(1)  # Simulate processing time
-    
-    # Process the PDF and get results
-    results = summarise(pdf_file_path)
-
-    UPLOAD_PROGRESS['progress'] = 40
-    time.sleep(1)  # Simulate processing time
-    
-    total_images = len(results)
-    
-    def progress_callback(current_image, total_images):
-        # Update the progress based on the current image
-        progress_start = 40
-        progress_end = 80
-        progress_range = progress_end - progress_start
-        progress_increment = progress_range / total_images
-        UPLOAD_PROGRESS['progress'] = int(round(progress_start + (current_image * progress_increment)))
-
-    # Generate images using the results as prompts
-    generated_images, docx_results = generate_images_from_prompts(results, progress_callback)
-
-    UPLOAD_PROGRESS['progress'] = 80
+UPLOAD_PROGRESS = {"progress": 0, "sentences": []}
+# Stream the final translation pass, showing its sentences and preparing their images as they arrive
+STREAM_TRANSLATION = True
+# Cancel token of the document being processed. A new upload or submission cancels it,
+# so the superseded job stops issuing translation and image requests.
+CURRENT_JOB = None
+job_lock = threading.Lock()
+
+def start_job():
+    global CURRENT_JOB
+    with job_lock:
+        if CURRENT_JOB is not None:
+            CURRENT_JOB.cancel()
+        CURRENT_JOB = CancelToken()
+        return CURRENT_JOB
+
+def cancel_current_job():
+    with job_lock:
+        if CURRENT_JOB is not None:
+            CURRENT_JOB.cancel()
+
+def process_pdf(pdf_file_path, extraction_backend='markdown', cancel_token=None):
+    global UPLOAD_PROGRESS, results, generated_images, docx_results, easy_read
+    cancel_token = cancel_token or CancelToken()
+
+    def set_progress(progress):
+        # A superseded job must not overwrite the progress of the job that replaced it
+        if not cancel_token.cancelled:
+            UPLOAD_PROGRESS['progress'] = progress
+
+    def on_sentence(sentence):
+        if cancel_token.cancelled:
+            return
+        UPLOAD_PROGRESS['sentences'].append(sentence)
+        prefetch_image(sentence, cancel_token)
+
+    try:
+        # Simulate progress updates
+        set_progress(10)
+        time.sleep(2.5)  # Simulate processing time
+
+        set_progress(20)
+        time.sleep(1)  # Simulate processing time
+
+        # Process the PDF and get results
+        job_results = summarise(pdf_file_path, backend=extraction_backend, cancel_token=cancel_token,
+                                on_sentence=on_sentence if STREAM_TRANSLATION else None)
+
+        set_progress(40)
+        time.sleep(1)  # Simulate processing time
+
+        def progress_callback(current_image, total_images):
+            # Update the progress based on the current image
+            progress_start = 40
+            progress_end = 80
+            progress_range = progress_end - progress_start
+            progress_increment = progress_range / total_images
+            set_progress(int(round(progress_start + (current_image * progress_increment))))
+
+        # Generate images using the results as prompts
+        job_images, job_docx = generate_images_from_prompts(job_results, progress_callback, cancel_token=cancel_token)
+        cancel_token.raise_if_cancelled()
+    except Exception as e:
+        # The upload of a cancelled job may already be gone, so any failure after cancellation is expected
+        if isinstance(e, JobCancelled) or cancel_token.cancelled:
+            print(f"Processing of {pdf_file_path} cancelled")
+            return
+        raise
+
+    results, generated_images, docx_results = job_results, job_images, job_docx
+
+    # The documents are built once the user has uploaded or skipped the template they are built on
+    easy_read = EasyReadDocument.from_results(results, generated_images)
+    document_builds.start(easy_read.snapshot(), prebuild=False)
+    # Section images of earlier documents are no longer used
+    prune_artifacts(section_image_dir, [image_path for _, image_path in generated_images], prefix="section_")
+
+    set_progress(80)
     time.sleep(1)  # Simulate processing time
 
-    # Remove the uploaded PDF file after processing
-    os.remove(pdf_file_path)
+    # Remove the uploaded PDF file after processing, unless it already belongs to the next upload
+    if not cancel_token.cancelled:
+        os.remove(pdf_file_path)
 
-    UPLOAD_PROGRESS['progress'] = 100
+    set_progress(100)
 
 @index_bp.route('/upload', methods=['POST'])
 def upload_file():
@@ -66,6 +118,9 @@ def upload_file():
         if not os.path.exists(files_dir):
             os.makedirs(files_dir)
 
+        # The new document supersedes any document still being processed
+        cancel_current_job()
+
         # Remove uploaded files stored on server side.
         temp_filenames = ["upload.pdf", "upload.docx"]
         for filename in temp_filenames:
@@ -96,11 +151,12 @@ def process():
 
     if request.method == 'POST' and form.validate_on_submit():
         UPLOAD_PROGRESS['progress'] = 0  # Reset progress
+        UPLOAD_PROGRESS['sentences'] = []
 
         file_path = "app/static/uploads/upload.pdf"
 
-        # Start the background thread for processing
-        thread = threading.Thread(target=process_pdf, args=(file_path,))
+        # Start the background thread for processing, cancelling the previous one
+        thread = threading.Thread(target=process_pdf, args=(file_path, form.extraction_backend.data, start_job()))
         thread.start()
 
         return render_template('processing.html')  # Render a template that shows the progress bar
@@ -111,6 +167,11 @@ def process():
 def get_progress():
     return jsonify(UPLOAD_PROGRESS)
 
+@index_bp.route('/stats', methods=['GET'])
+def get_stats():
+    return jsonify({'image_cache': image_cache.stats(), 'image_library': image_library.stats(), 'api': api_stats(),
+                    'layout': layout_stats()})
+
 @index_bp.route('/upload-template', methods=['GET', 'POST'])
 def upload_template():
     if request.method == 'POST':
@@ -150,6 +211,10 @@ def upload_template():
         else:
             filetype = 'PDF'
             temp_file_path = file_path
+            # Build the documents of every template on the chosen template PDF while the user picks one.
+            # Always rebuilt, since a changed template may be uploaded under the same name.
+            if easy_read is not None:
+                document_builds.start(easy_read.snapshot(), temp_file_path)
             
         return redirect('/choose-template')
     
@@ -176,67 +241,165 @@ def docx():
     print("BOXES:", docx_boxes)
     output_file = f'app/static/docx/output.docx'
     create_docx(output_file, docx_results, docx_boxes, temp_file_path)
+    # Served under its content hash, replacing the previous document's file
+    output_file = publish_file(output_file)
+    prune_artifacts(os.path.dirname(output_file), [output_file], prefix="output")
     
-    return render_template('docx.html')
+    return render_template('docx.html', docx_url='/' + os.path.relpath(output_file, 'app'))
     
 
-TOTAL_PAGES = None
-page_text_boxes = None
+# With CLIENT_RENDERING, editor pages are rendered by the browser from the PDF, with the text boxes
+# overlaid from JSON, and pages are only rasterized on the server for clients that cannot render PDFs
+# (render=server). It needs pdf.js in app/static/pdfjs (`npm run vendor:pdfjs`), which is not
+# committed yet, so pages are rasterized on the server by default.
+CLIENT_RENDERING = False
+
+# Documents of every template, built in the background once processing finishes and after each edit.
+# Their pages are rasterized ahead of time only when the editor shows server-rendered images by default.
+document_builds = DocumentBuilds(rasterize=not CLIENT_RENDERING)
+# Groups of the processed document, with the user's edits
+easy_read = None
 template = None
 
 @index_bp.route('/display')
 def display():
-    global TOTAL_PAGES, page_text_boxes, all_groups, mapping, template
+    global template
 
     # Get the selected template variable from the query parameters
     temp = int(request.args.get('template', 999)) 
     if template is None or (temp != template and temp != 999):
         template = temp
     
-    # Check if TOTAL_PAGES and page_text_boxes are already set
-    if TOTAL_PAGES is None or page_text_boxes is None:
-        TOTAL_PAGES, page_text_boxes, all_groups, mapping = compile_info_for_pdf(results, generated_images, template, temp_file_path)
-    else:
-        TOTAL_PAGES, page_text_boxes = caller(all_groups, template, temp_file_path)
+    # The browser renders the page itself unless it has fallen back to server-rendered images
+    render_mode = request.args.get('render', 'client' if CLIENT_RENDERING else 'server')
+
+    # Switching templates only swaps to the document already built for it. Server-rendered pages are
+    # shown from their previews while the full-resolution pages are rendered.
+    document = document_builds.get(template, preview=True, rasterize=render_mode == 'server')
+    if document is None:
+        return redirect('/')
+    TOTAL_PAGES = document['total_pages']
 
     # Get the current page from the query parameters (default to 1)
     page = int(request.args.get('page', 1))
     if page < 1 or page > TOTAL_PAGES:
         page = 1
 
+    if render_mode == 'client':
+        # The PDF and the boxes of every page are fetched by the page, which navigates between pages locally
+        return render_template(
+            'display_client.html',
+            pdf_url=f"/document-pdf/{document['pdf_hash']}",
+            boxes_url=f"/document-boxes/{document['pdf_hash']}",
+            total_pages=TOTAL_PAGES,
+            current_page=page,
+            selected_template=int(template),
+            font_size=BODY_FONT_SIZE
+        )
+
+    image_dir = os.path.relpath(document['image_dir'], 'app')
+
     # Render the requested page and its text boxes
     return render_template(
         'display.html',
         total_pages=TOTAL_PAGES,
-        text_boxes=page_text_boxes.get(page, {}),
+        text_boxes=document['pagination'].boxes(easy_read.groups, page),
         current_page=page,
-        selected_template=int(template)
+        selected_template=int(template),
+        page_image=f"/{image_dir}/{document['page_images'][page - 1]}" if document['full_resolution'] else f"/page-image/{page}",
+        preview_image=f"/{image_dir}/{document['preview_images'][page - 1]}" if document['preview_images'] else None,
+        full_resolution=document['full_resolution']
     )
 
+@index_bp.route('/page-image/<int:page>')
+def page_image(page):
+    # Waits for the full-resolution pages of the displayed template, then redirects to the page's image
+    document = document_builds.get(template, rasterize=True)
+    if document is None or not 1 <= page <= document['total_pages']:
+        return jsonify({"error": "No such page"}), 404
+    image_dir = os.path.relpath(document['image_dir'], 'app')
+    return redirect(f"/{image_dir}/{document['page_images'][page - 1]}")
+
+@index_bp.route('/document-pdf/<pdf_hash>')
+def document_pdf(pdf_hash):
+    # The PDF of the displayed template, rendered by the browser in the editor. Its URL names its
+    # content, so it is cached for good and an edited document is fetched from a new URL.
+    # A page loaded before the last edit asks for an outdated hash, and is sent to the current PDF.
+    document = document_builds.get(template)
+    if document is None:
+        return jsonify({"error": "No document has been processed"}), 404
+    if document['pdf_hash'] != pdf_hash:
+        return redirect(f"/document-pdf/{document['pdf_hash']}")
+    response = send_file(BytesIO(document['pdf_bytes']), mimetype='application/pdf', etag=pdf_hash, max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@index_bp.route('/document-boxes/<pdf_hash>')
+def document_boxes(pdf_hash):
+    # Text boxes of every page of the displayed template, with where they are drawn in points.
+    # Named by the hash of the PDF they were laid out in, and sent to the current one like document_pdf.
+    document = document_builds.get(template)
+    if document is None:
+        return jsonify({"error": "No document has been processed"}), 404
+    if document['pdf_hash'] != pdf_hash:
+        return redirect(f"/document-boxes/{document['pdf_hash']}")
+    return jsonify({
+        "total_pages": document['total_pages'],
+        "pages": document['pagination'].pages(easy_read.groups),
+    })
+
 @index_bp.route('/submit', methods=['POST'])
 def submit():
+    document = document_builds.get(template)
+    if document is None:
+        return redirect('/')
+    TOTAL_PAGES, pagination = document['total_pages'], document['pagination']
+
     # Get the current page from the form (ensure it's valid)
     page = int(request.form.get('page', 1))
     if page < 1 or page > TOTAL_PAGES:
         page = 1
 
-    # Ensure the page exists in the dictionary
-    if page not in page_text_boxes:
-        page_text_boxes[page] = {}
-
     # Update the text box content for the current page
     for key, value in request.form.items():
         if key.startswith('box'):  # Only update keys that start with 'box'
-            update_text(all_groups, page_text_boxes, mapping, page, key, value)
+            index = pagination.group_index(page, key)
+            if index is not None:
+                easy_read.set_text(index, value)
 
     # Debugging: Print the updated page content to the console
-    print(f"Updated Text Boxes for Page {page}:", page_text_boxes[page])
-    print("All Text Boxes:", page_text_boxes)
+    print(f"Updated Text Boxes for Page {page}:", pagination.boxes(easy_read.groups, page))
+
+    # Rebuild every template with the edits, the one being displayed first
+    document_builds.start(easy_read.snapshot(), document_builds.temp_path, first=template)
 
-    # Redirect back to the same page
-    return redirect(f"/display?page={page}")
+    # Redirect back to the same page, in the same display mode
+    render_mode = request.form.get('render')
+    return redirect(f"/display?page={page}" + (f"&render={render_mode}" if render_mode else ""))
 
 @index_bp.route('/download-pdf')
 def download_pdf():
-    pdf_path = "static/pdf/output.pdf"  # Update this to match your PDF file's location
-    return send_file(pdf_path, as_attachment=True, download_name="output.pdf")
+    document = document_builds.get(template)
+    if document is None:
+        return redirect('/')
+    # Served from the bytes kept with the built document, without writing or re-reading a file.
+    # The ETag is the PDF's content hash, so an unchanged document is not downloaded again.
+    return send_file(BytesIO(document['pdf_bytes']), mimetype='application/pdf', as_attachment=True, download_name="output.pdf",
+                     etag=document['pdf_hash'], max_age=0)
+
+@index_bp.after_app_request
+def cache_artifacts(response):
+    """
+    Static files named by content hash (see artifacts) never change, so browsers and CDNs may keep them
+    for good. Their ETag is the hash, which also answers any revalidation with 304 Not Modified.
+    """
+    digest = artifact_hash(request.path) if request.endpoint == 'static' else None
+    if digest is not None and response.status_code == 200:
+        response.set_etag(digest)
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+        response.make_conditional(request)
+    return response
@@ -1,6 +1,8 @@
-from context_generation import extract, preprocess
-from context_clustering import cluster_sentences
+from context_generation import iter_extract, iter_preprocess
+from context_clustering import cluster_sentences, embed_sentences
+from group_planning import plan_translation
 from translation import translate
+from jobs import raise_if_cancelled
 import os
 
 
@@ -9,11 +11,15 @@ def split_into_sentences(text):
     return sentences
 
 
-def summarise(pdf_path):
-    extracted_text = extract(pdf_path)
-    preprocessed_text = preprocess(extracted_text)
-    grouped_paragraphs = cluster_sentences(preprocessed_text)
-    array_2d = [split_into_sentences(translate(" ".join(group))) for group in grouped_paragraphs]
+def summarise(pdf_path, backend='markdown', cancel_token=None, on_sentence=None):
+    # on_sentence, if given, receives each sentence of the summary as soon as its translation streams in
+    # Pages are extracted in parallel shards and embedded as they arrive
+    preprocessed_text, embeddings = embed_sentences(iter_preprocess(iter_extract(pdf_path, backend=backend)))
+    raise_if_cancelled(cancel_token)
+    grouped_paragraphs = cluster_sentences(preprocessed_text, embeddings=embeddings)
+    # Merge tiny clusters, drop repeated sentences and pack groups to cut the number of translate calls
+    translation_inputs = plan_translation(grouped_paragraphs, preprocessed_text, embeddings)
+    array_2d = [split_into_sentences(translate(text, cancel_token, on_sentence)) for text in translation_inputs]
     ai_summary = [item for sublist in array_2d for item in sublist]
     
     # Save preprocessed text to app/text/output.txt
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import re
+
+# Generated files (page images, section images, DOCX) are named by the hash of their content, as
+# name.<hash>.ext, so a URL always refers to the same bytes. Browsers and CDNs can then keep them
+# for good, and an edited document gets new URLs instead of stale cached files.
+
+HASH_LENGTH = 16
+# Cache-Control of content-hashed files: cache for a year without revalidating
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+HASHED_NAME = re.compile(rf'\.([0-9a-f]{{{HASH_LENGTH}}})\.[A-Za-z0-9]+$')
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def hashed_name(filename, digest):
+    # "pdf_page_0.jpg" -> "pdf_page_0.<hash>.jpg"
+    stem, extension = os.path.splitext(filename)
+    return f"{stem}.{digest}{extension}"
+
+
+def artifact_hash(path):
+    """
+    Returns the content hash in a content-hashed file name, or None for any other file.
+    """
+    match = HASHED_NAME.search(path)
+    return match.group(1) if match else None
+
+
+def write_artifact(directory, filename, data):
+    """
+    Write `data` as the content-hashed version of `filename` in `directory`, unless that file
+    already exists, and return its path.
+    """
+    path = os.path.join(directory, hashed_name(filename, content_hash(data)))
+    if not os.path.exists(path):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # Written under a temporary name first, so the hashed name never refers to a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    return path
+
+
+def publish_file(path, filename=None):
+    """
+    Rename a generated file to its content-hashed name and return the new path.
+    The hashed name is built from `filename` if given, otherwise from the file's own name.
+    """
+    filename = filename or os.path.basename(path)
+    hashed_path = os.path.join(os.path.dirname(path), hashed_name(filename, file_hash(path)))
+    os.replace(path, hashed_path)
+    return hashed_path
+
+
+def prune_artifacts(directory, keep, prefix=""):
+    """
+    Remove the content-hashed files starting with `prefix` in `directory` whose paths are not in `keep`.
+    """
+    if not os.path.isdir(directory):
+        return
+    keep = {os.path.normpath(path) for path in keep}
+    for filename in os.listdir(directory):
+        path = os.path.normpath(os.path.join(directory, filename))
+        if filename.startswith(prefix) and artifact_hash(filename) is not None and path not in keep:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Warning: Could not remove {path}. Error: {e}")
@@ -0,0 +1,261 @@
+import os
+import time
+from context_generation import EXTRACTION_BACKENDS, extract_pages, preprocess, preprocess_bulk
+
+# Benchmarks for the document pipeline. Run with `python benchmarks.py`.
+# They use the sample documents in dir/ and do not call any external API
+# (image generation uses the local backend from image_backends).
+
+BENCHMARK_DIR = 'dir'
+
+
+def sample_pdfs(directory=BENCHMARK_DIR):
+    return [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith('.pdf')]
+
+
+def benchmark_extraction(pdf_paths):
+    """
+    Compares the extraction backends for speed, and for how many preprocessed sentences they agree on.
+    Overlap is the Jaccard index of each backend's sentence set against the markdown backend.
+    """
+    timings = {backend: 0.0 for backend in EXTRACTION_BACKENDS}
+    overlaps = {backend: [] for backend in EXTRACTION_BACKENDS}
+
+    for pdf_path in pdf_paths:
+        sentence_sets = {}
+        for backend, extract_shard in EXTRACTION_BACKENDS.items():
+            start = time.perf_counter()
+            text = extract_shard(pdf_path, None)
+            timings[backend] += time.perf_counter() - start
+            sentence_sets[backend] = set(preprocess(text))
+
+        reference = sentence_sets['markdown']
+        for backend, sentences in sentence_sets.items():
+            union = reference | sentences
+            overlaps[backend].append(len(reference & sentences) / len(union) if union else 1.0)
+
+    print(f"Extraction over {len(pdf_paths)} documents:")
+    for backend in EXTRACTION_BACKENDS:
+        mean_overlap = sum(overlaps[backend]) / len(overlaps[backend]) if overlaps[backend] else 0.0
+        print(f"  {backend:<10} {timings[backend]:8.3f}s  sentence overlap with markdown: {mean_overlap:.1%}")
+    return timings, overlaps
+
+
+def benchmark_preprocessing(pdf_paths, repeat=5, copies=20):
+    """
+    Micro-benchmark of `preprocess` against `preprocess_bulk` on a long document,
+    made by concatenating the sample documents `copies` times. Fails if the outputs differ.
+    """
+    text = "\n\n".join(extract_pages(pdf_path) for pdf_path in pdf_paths) * copies
+
+    timings = {}
+    outputs = {}
+    for name, func in [('preprocess', preprocess), ('preprocess_bulk', preprocess_bulk)]:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            outputs[name] = func(text)
+        timings[name] = (time.perf_counter() - start) / repeat
+
+    assert outputs['preprocess'] == outputs['preprocess_bulk'], "preprocess_bulk output differs from preprocess"
+    print(f"Preprocessing {len(text)} characters ({len(outputs['preprocess'])} unique sentences):")
+    for name, seconds in timings.items():
+        print(f"  {name:<16} {seconds * 1000:8.1f}ms")
+    print(f"  speedup: {timings['preprocess'] / timings['preprocess_bulk']:.2f}x")
+    return timings
+
+
+def benchmark_image_pipeline(n_sentences=40, latency=2.0, error_rate=0.05, max_workers=4, template=3):
+    """
+    Throughput of image generation, PDF layout and rasterization, and DOCX generation
+    under realistic concurrency, with the local image backend standing in for DALL-E.
+    Everything is written to a temporary directory: the image cache and library are swapped for empty
+    ones there, so every run generates every image and the placeholder images never reach the real
+    cache or library, and the section images, page images and DOCX are written there too.
+    """
+    import tempfile
+    import generate_images
+    from image_backends import LocalImageBackend
+    from image_cache import ImageCache
+    from image_library import ImageLibrary
+    from document_model import EasyReadDocument
+    from pdf_generation import build_document, render_document
+    from word_generation import create_docx
+
+    sentences = [f"Sentence number {i} tells you about your support plan." for i in range(n_sentences)]
+
+    timings = {}
+    saved = generate_images.image_backend, generate_images.image_cache, generate_images.image_library, generate_images.image_dir
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            generate_images.image_backend = LocalImageBackend(latency=latency, error_rate=error_rate)
+            generate_images.image_cache = ImageCache(os.path.join(directory, "image_cache"))
+            generate_images.image_library = ImageLibrary(os.path.join(directory, "image_library"))
+            generate_images.image_dir = os.path.join(directory, "images")
+            os.mkdir(generate_images.image_dir)
+            start = time.perf_counter()
+            images, docx = generate_images.generate_images_from_prompts(sentences, max_workers=max_workers)
+            timings['images'] = time.perf_counter() - start
+        finally:
+            (generate_images.image_backend, generate_images.image_cache,
+             generate_images.image_library, generate_images.image_dir) = saved
+
+        start = time.perf_counter()
+        document = build_document(EasyReadDocument.from_results(sentences, images).groups, template)
+        document['image_dir'] = os.path.join(directory, "pages")
+        total_pages = render_document(document)['total_pages']
+        timings['pdf'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        create_docx(os.path.join(directory, "benchmark.docx"), docx, template, None)
+        timings['docx'] = time.perf_counter() - start
+
+    print(f"Pipeline with local image backend ({n_sentences} sentences, {latency}s latency, "
+          f"{error_rate:.0%} errors, {max_workers} workers, {total_pages} pages):")
+    for stage, seconds in timings.items():
+        print(f"  {stage:<8} {seconds:8.2f}s  {n_sentences / seconds:8.1f} sentences/s")
+    return timings
+
+
+def benchmark_line_breaking(n_groups=50, words_per_group=(20, 100, 400), repeat=3):
+    """
+    Time of measuring group heights with calculate_group_height (a font and a measurement of the
+    whole line per word) and with group_height (cached fonts and word widths), on groups of increasing length.
+    """
+    import random
+    import fitz
+    from pdf_generation import calculate_group_height, group_height
+
+    page = fitz.open().new_page(width=595, height=842)
+    vocabulary = ("you can ask your support worker to help you pay the rent each week "
+                  "your plan tells you about the money you get from the NDIS").split()
+    rng = random.Random(0)
+
+    print("Line breaking:")
+    for n_words in words_per_group:
+        groups = [" ".join(rng.choice(vocabulary) for _ in range(n_words)) for _ in range(n_groups)]
+        timings = {}
+        for function in (calculate_group_height, group_height):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                heights = [function(page, text) for text in groups]
+            timings[function.__name__] = (time.perf_counter() - start) / repeat
+            if function is calculate_group_height:
+                expected = heights
+        assert heights == expected, "group_height differs from calculate_group_height"
+        print(f"  {n_groups} groups of {n_words} words: "
+              f"{timings['calculate_group_height'] * 1000:8.1f}ms -> {timings['group_height'] * 1000:6.1f}ms "
+              f"({timings['calculate_group_height'] / timings['group_height']:.0f}x)")
+    return timings
+
+
+def letterhead_template(directory, header_size=(512, 512)):
+    """
+    Writes a template with a header image and text on its page, like an organisation's letterhead,
+    and an image for the groups. Returns the paths of the template and the image.
+    """
+    import fitz
+    from PIL import Image
+
+    image_path = os.path.join(directory, "image.jpg")
+    Image.effect_noise((512, 512), 60).convert("RGB").save(image_path)
+    header_path = os.path.join(directory, "header.png")
+    Image.effect_noise(header_size, 60).convert("RGB").save(header_path)
+    template_path = os.path.join(directory, "template.pdf")
+    template = fitz.open()
+    page = template.new_page(width=595, height=842)
+    page.insert_image(fitz.Rect(40, 20, 140, 80), filename=header_path)
+    page.insert_text((160, 50), "Easy Read", fontsize=24)
+    page.insert_text((40, 820), "Footer text on every page " * 3, fontsize=8)
+    template.save(template_path)
+    template.close()
+    return template_path, image_path
+
+
+def generate_pdf(output_path, template_path, groups, groups_per_page):
+    # Build a document on the template, serialize it and write it to output_path
+    import pdf_generation
+
+    doc, _, _ = pdf_generation.build_pdf(template_path, groups, groups_per_page)
+    with open(output_path, 'wb') as f:
+        f.write(pdf_generation.pdf_bytes(doc, pdf_generation.source_size(template_path, groups)))
+    doc.close()
+
+
+def benchmark_template_stamping(page_counts=(10, 50, 200), repeat=3):
+    """
+    Time of generate_pdf on a template PDF when the template is opened for every document
+    (emptying the template cache first) and when the opened template is reused.
+    """
+    import tempfile
+    import pdf_generation
+
+    with tempfile.TemporaryDirectory() as directory:
+        template_path, image_path = letterhead_template(directory)
+
+        output_path = os.path.join(directory, "output.pdf")
+        print("Template stamping:")
+        for pages in page_counts:
+            groups = [[image_path, f"Sentence {i} about your plan."] for i in range(pages * 3)]
+            timings = {}
+            for name, clear in (("reopened", True), ("cached", False)):
+                generate_pdf(output_path, template_path, groups, 3)
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    if clear:
+                        pdf_generation.template_cache.clear()
+                    generate_pdf(output_path, template_path, groups, 3)
+                timings[name] = (time.perf_counter() - start) / repeat
+            print(f"  {pages} pages: reopened {timings['reopened'] * 1000:8.1f}ms, "
+                  f"cached {timings['cached'] * 1000:8.1f}ms")
+        pdf_generation.template_cache.clear()
+    return timings
+
+
+def benchmark_pdf_size(pages=20, header_size=(1600, 1000)):
+    """
+    Size of a generated PDF built on the template as it is and saved with default options, and
+    built on the optimized template and saved by pdf_bytes, on a template whose letterhead image
+    is embedded at full resolution. The time covers opening the template and saving the document.
+    """
+    import tempfile
+    import pdf_generation
+    from document_model import Group
+
+    optimize_template_images = pdf_generation.OPTIMIZE_TEMPLATE_IMAGES
+    with tempfile.TemporaryDirectory() as directory:
+        template_path, image_path = letterhead_template(directory, header_size)
+        groups = [Group(image_path, f"Sentence {i} about your plan.") for i in range(pages * 3)]
+        try:
+            pdf_generation.OPTIMIZE_TEMPLATE_IMAGES = False
+            doc, _, _ = pdf_generation.build_pdf(template_path, groups, 3)
+            sizes = {'default': len(doc.tobytes())}
+            doc.close()
+            pdf_generation.template_cache.clear()
+
+            pdf_generation.OPTIMIZE_TEMPLATE_IMAGES = True
+            start = time.perf_counter()
+            pdf_generation.open_template(template_path)
+            elapsed = time.perf_counter() - start
+            doc, _, _ = pdf_generation.build_pdf(template_path, groups, 3)
+            start = time.perf_counter()
+            sizes['optimized'] = len(pdf_generation.pdf_bytes(doc))
+            elapsed += time.perf_counter() - start
+            doc.close()
+        finally:
+            pdf_generation.OPTIMIZE_TEMPLATE_IMAGES = optimize_template_images
+            pdf_generation.template_cache.clear()
+
+    print(f"PDF size ({pages} pages): default {sizes['default'] / 1024:.0f}KB, "
+          f"optimized {sizes['optimized'] / 1024:.0f}KB "
+          f"({sizes['optimized'] / sizes['default']:.0%}) in {elapsed * 1000:.0f}ms")
+    return sizes
+
+
+if __name__ == "__main__":
+    pdf_paths = sample_pdfs()
+    benchmark_extraction(pdf_paths)
+    benchmark_preprocessing(pdf_paths)
+    benchmark_image_pipeline()
+    benchmark_line_breaking()
+    benchmark_template_stamping()
+    benchmark_pdf_size()
@@ -9,9 +9,14 @@ from bertopic.representation import KeyBERTInspired
 from nltk import word_tokenize          
 from nltk.stem import WordNetLemmatizer 
 from nltk.corpus import stopwords
+from functools import lru_cache
+import numpy as np
 import gensim.corpora as corpora
 from gensim.models.coherencemodel import CoherenceModel
 
+# Number of sentences sent to the embedding model at once when embedding a stream of sentences
+EMBEDDING_BATCH_SIZE = 64
+
 # https://github.com/MaartenGr/BERTopic/issues/286
 class LemmaTokenizer:
     def __init__(self):
@@ -25,35 +30,61 @@ class LemmaTokenizer:
 # Documentation: https://maartengr.github.io/BERTopic/index.html
 # We have also considered LDA and normal DBSCAN. See older commits for that. Feel free to replace the current model with those!
 
-def cluster_sentences(sentences, config={}):
+@lru_cache(maxsize=None)
+def get_sentence_model(model_name='all-MiniLM-L6-v2'):
+    # Loading the model is slow, so it is loaded once per process and shared
+    return SentenceTransformer(model_name)
+
+def embed_sentences(sentences, model_name='all-MiniLM-L6-v2', batch_size=EMBEDDING_BATCH_SIZE):
     """
-    Parameters:
-    -----------
-    sentences : list of str
-        List of sentences to be clustered.
-    config : dict
-        Dictionary of hyperparameters for the clustering model.
-        Default values are:
-        - embedding_model: 'all-MiniLM-L6-v2'
-        - min_cluster_size: 8
-        - min_samples: 8
-        - cluster_selection_epsilon: 0.0
-        - cluster_selection_method: 'leaf'
-        - ngram_range: (1, 2)
-        - max_df: 1.0
-        - min_df: 1
-        - nr_topics: 20
+    Embed an iterable of sentences in batches as they arrive, so embedding can overlap with extraction.
 
     Returns:
     --------
-    result : list of list of str
-        A list of groups, where each group is a list of sentences that belong to the same topic.
-    coherence : float
-        The coherence score of the topics.
+    sentences : list of str
+        The sentences that were embedded, in order.
+    embeddings : numpy.ndarray
+        The normalized embeddings, one row per sentence.
     """
+    sentence_model = get_sentence_model(model_name)
+    collected = []
+    batches = []
+    batch = []
+    for sentence in sentences:
+        batch.append(sentence)
+        if len(batch) == batch_size:
+            batches.append(sentence_model.encode(batch))
+            collected.extend(batch)
+            batch = []
+    if batch:
+        batches.append(sentence_model.encode(batch))
+        collected.extend(batch)
+
+    if not batches:
+        return collected, np.empty((0, sentence_model.get_sentence_embedding_dimension()))
+    return collected, normalize(np.vstack(batches))
+
+def build_vectorizer(config={}):
+    stop_words = stopwords.words('english')
+    domain_specific_stopwords = [] # e.g. 'disability', 'service', 'intellectual'. Make sure you know what you're doing!
+    stop_words.extend(domain_specific_stopwords)
 
-    sentence_model = SentenceTransformer(config.get('embedding_model', 'all-MiniLM-L6-v2'))
-    embeddings = normalize(sentence_model.encode(sentences))
+    return CountVectorizer(
+        stop_words=stop_words,
+        tokenizer=LemmaTokenizer(),
+        ngram_range=config.get('ngram_range', (1, 3)),
+        max_df=config.get('max_df', 1.0),
+        min_df=config.get('min_df', 1),
+    )
+
+def fit_topic_model(sentences, config={}, embeddings=None):
+    """
+    Fit the BERTopic model used by `cluster_sentences` and return it with the topic of each sentence.
+    See `cluster_sentences` for the parameters.
+    """
+    sentence_model = get_sentence_model(config.get('embedding_model', 'all-MiniLM-L6-v2'))
+    if embeddings is None:
+        embeddings = normalize(sentence_model.encode(sentences))
 
     umap_model = UMAP(random_state=42)
 
@@ -66,17 +97,7 @@ def cluster_sentences(sentences, config={}):
         prediction_data=True,
     )
 
-    stop_words = stopwords.words('english')
-    domain_specific_stopwords = [] # e.g. 'disability', 'service', 'intellectual'. Make sure you know what you're doing!
-    stop_words.extend(domain_specific_stopwords)
-
-    vectorizer_model = CountVectorizer(
-        stop_words=stop_words,
-        tokenizer=LemmaTokenizer(),
-        ngram_range=config.get('ngram_range', (1, 3)),
-        max_df=config.get('max_df', 1.0),
-        min_df=config.get('min_df', 1),
-    )
+    vectorizer_model = build_vectorizer(config)
 
     representation_model = KeyBERTInspired()
     
@@ -94,6 +115,39 @@ def cluster_sentences(sentences, config={}):
     # removing stopwords from topic representation
     topic_model.update_topics(sentences, vectorizer_model=vectorizer_model)
 
+    return topic_model, topics
+
+def cluster_sentences(sentences, config={}, embeddings=None):
+    """
+    Parameters:
+    -----------
+    sentences : list of str
+        List of sentences to be clustered.
+    config : dict
+        Dictionary of hyperparameters for the clustering model.
+        Default values are:
+        - embedding_model: 'all-MiniLM-L6-v2'
+        - min_cluster_size: 8
+        - min_samples: 8
+        - cluster_selection_epsilon: 0.0
+        - cluster_selection_method: 'leaf'
+        - ngram_range: (1, 2)
+        - max_df: 1.0
+        - min_df: 1
+        - nr_topics: 20
+    embeddings : numpy.ndarray, optional
+        Precomputed normalized embeddings (e.g. from `embed_sentences`). Computed here if not given.
+
+    Returns:
+    --------
+    result : list of list of str
+        A list of groups, where each group is a list of sentences that belong to the same topic.
+    coherence : float
+        The coherence score of the topics.
+    """
+
+    topic_model, topics = fit_topic_model(sentences, config, embeddings)
+
     print(topic_model.get_topic_info())
 
     groups = {t: [] for t in range(-1, max(topics)+1)}
@@ -114,12 +168,24 @@ def cluster_sentences(sentences, config={}):
     
     return result
 
-def calculate_coherence_score(sentences, groups, topic_model):
+def coherence_corpus(sentences, analyzer):
+    """
+    Tokenized texts, gensim dictionary and bag-of-words corpus used by `calculate_coherence_score`.
+    They only depend on the sentences and the vectorizer's analyzer, so callers scoring many models
+    on the same sentences can build them once and pass them in.
+    """
+    texts = [analyzer(doc) for doc in sentences]
+    dictionary = corpora.Dictionary(texts)
+    corpus = [dictionary.doc2bow(text) for text in texts]
+    return texts, dictionary, corpus
+
+def calculate_coherence_score(sentences, groups, topic_model, precomputed_corpus=None):
     """
     Coherence score tells you how well the words in a topic are related to each other. 
     0 means no relation (e.g. random words), 1 means perfect relation (e.g. synonyms).
     https://www.reddit.com/r/LanguageTechnology/comments/ap36l1/what_is_a_good_coherence_score_for_an_lda_model/
     https://stackoverflow.com/questions/54762690/evaluation-of-topic-modeling-how-to-understand-a-coherence-value-c-v-of-0-4
+    `precomputed_corpus` is the result of `coherence_corpus` for these sentences, if already built.
     """
 
     # Get top words for each topic
@@ -130,12 +196,11 @@ def calculate_coherence_score(sentences, groups, topic_model):
         top_words.append(words)
     
     # https://stackoverflow.com/questions/70548316/gensim-coherencemodel-gives-valueerror-unable-to-interpret-topic-as-either-a-l
-    vectorizer = topic_model.vectorizer_model
-    analyzer = vectorizer.build_analyzer()
-
-    texts = [analyzer(doc) for doc in sentences]
-    dictionary = corpora.Dictionary(texts)
-    corpus = [dictionary.doc2bow(text) for text in texts]
+    if precomputed_corpus is None:
+        vectorizer = topic_model.vectorizer_model
+        analyzer = vectorizer.build_analyzer()
+        precomputed_corpus = coherence_corpus(sentences, analyzer)
+    texts, dictionary, corpus = precomputed_corpus
 
     coherence_model = CoherenceModel(
         topics=top_words,
@@ -146,4 +211,3 @@ def calculate_coherence_score(sentences, groups, topic_model):
     )
 
     return coherence_model.get_coherence()
-
@@ -1,8 +1,87 @@
 import optuna
 import numpy as np
 import os
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.model_selection import cross_val_score
-from context_clustering import cluster_sentences
+from context_clustering import build_vectorizer, calculate_coherence_score, coherence_corpus, embed_sentences, fit_topic_model
+
+CORPUS_DIR = 'dir/'
+# Sentence embeddings of each corpus file are computed once and cached here, keyed by file content
+CACHE_DIR = 'processed/tuning_cache'
+# Trials from every worker process are recorded in the same study. Each run gets its own study, named after
+# the corpus and the search space, so trials of earlier runs never feed the best trial or the pruner's medians.
+STUDY_NAME = 'context_clustering'
+STORAGE = 'sqlite:///processed/tuning.db'
+# Bump when the search space in objective changes, so resumed studies only hold comparable trials
+SEARCH_SPACE_VERSION = 1
+
+def make_pruner():
+    # Prune trials whose running average falls below the median of earlier trials at the same file
+    return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=1)
+
+# Per-process state shared by every trial run in that process
+_corpus = None
+_coherence_corpora = {}
+
+def load_corpus(directory=CORPUS_DIR, cache_dir=CACHE_DIR):
+    """
+    Read every .txt file in the directory and embed its sentences, reusing embeddings cached on disk.
+
+    Returns:
+    --------
+    list of (str, list of str, numpy.ndarray)
+        Filename, sentences and normalized sentence embeddings of each file.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    corpus = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.txt'):
+            with open(os.path.join(directory, filename), 'r') as f:
+                sentences = f.readlines()
+
+            digest = hashlib.sha1("".join(sentences).encode('utf-8')).hexdigest()[:16]
+            cache_path = os.path.join(cache_dir, f"{filename}.{digest}.npy")
+            if os.path.exists(cache_path):
+                embeddings = np.load(cache_path)
+            else:
+                sentences, embeddings = embed_sentences(sentences)
+                np.save(cache_path, embeddings)
+            corpus.append((filename, sentences, embeddings))
+    return corpus
+
+def corpus_key(corpus):
+    # Identifies the corpus by its files' names and contents
+    digest = hashlib.sha1()
+    for filename, sentences, _ in corpus:
+        digest.update(filename.encode('utf-8'))
+        digest.update("".join(sentences).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+def make_study_name(corpus, resume=False):
+    """
+    Name of the study of a tuning run. With `resume`, a run continues the study of earlier runs on the
+    same corpus and search space; otherwise every run starts a new study.
+    """
+    name = f"{STUDY_NAME}-{corpus_key(corpus)}-v{SEARCH_SPACE_VERSION}"
+    return name if resume else f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+def get_corpus():
+    global _corpus
+    if _corpus is None:
+        _corpus = load_corpus()
+    return _corpus
+
+def get_coherence_corpus(filename, sentences, ngram_range):
+    # The coherence corpus only depends on the analyzer, which only varies with ngram_range between trials
+    key = (filename, tuple(ngram_range))
+    if key not in _coherence_corpora:
+        analyzer = build_vectorizer({'ngram_range': ngram_range}).build_analyzer()
+        _coherence_corpora[key] = coherence_corpus(sentences, analyzer)
+    return _coherence_corpora[key]
 
 def objective(trial):
     """
@@ -38,27 +117,46 @@ def objective(trial):
     try:
         total_coherence = 0
         file_count = 0
-        for filename in os.listdir('dir/'):
-            if filename.endswith('.txt'):
-                with open(os.path.join('dir/', filename), 'r') as f:
-                    sentences = f.readlines()
-                groups, coherence = cluster_sentences(sentences, config)
-                total_coherence += coherence
-                file_count += 1
+        for filename, sentences, embeddings in get_corpus():
+            topic_model, topics = fit_topic_model(sentences, config, embeddings)
+            groups = [t for t in sorted(set(topics)) if t != -1] or [-1]
+            precomputed_corpus = get_coherence_corpus(filename, sentences, config['ngram_range'])
+            total_coherence += calculate_coherence_score(sentences, groups, topic_model, precomputed_corpus)
+            file_count += 1
+
+            # Report the running average so unpromising trials can be pruned before seeing every file
+            trial.report(total_coherence / file_count, file_count)
+            if trial.should_prune():
+                raise optuna.TrialPruned()
         
         average_coherence = total_coherence / file_count if file_count > 0 else -np.inf
         
         return average_coherence
     
+    except optuna.TrialPruned:
+        raise
     except Exception as e:
         print(f"Trial failed: {e}")
         return -np.inf
 
+def run_trials(study_name, storage, n_trials, timeout, show_progress_bar=False):
+    # Runs in a worker process: load the shared study and add trials to it
+    study = optuna.load_study(study_name=study_name, storage=storage, pruner=make_pruner())
+    study.optimize(
+        objective,
+        n_trials=n_trials,
+        timeout=timeout,
+        show_progress_bar=show_progress_bar
+    )
+
 def tune_hyperparameters(
     sentences, 
     n_trials=100, 
     timeout=3600,  # 1 hour timeout
-    show_progress_bar=True
+    show_progress_bar=True,
+    n_jobs=os.cpu_count(),
+    storage=STORAGE,
+    resume=False,
 ):
     """
     Perform hyperparameter tuning using Optuna
@@ -72,21 +170,47 @@ def tune_hyperparameters(
     timeout : int, optional
         Maximum time (in seconds) to run optimization
     show_progress_bar : bool, optional
-        Whether to show Optuna progress bar
+        Whether to show Optuna progress bar (for the first worker)
+    n_jobs : int, optional
+        Number of worker processes running trials in parallel
+    storage : str, optional
+        Optuna storage URL shared by the workers
+    resume : bool, optional
+        Whether to continue the study of earlier runs on the same corpus and search space
     
     Returns:
     --------
     dict
         Best hyperparameters and corresponding coherence score
     """
+    if storage.startswith('sqlite:///'):
+        storage_dir = os.path.dirname(storage[len('sqlite:///'):])
+        if storage_dir and not os.path.exists(storage_dir):
+            os.makedirs(storage_dir)
+
+    # Embed the corpus once up front, so the workers inherit it or only load the cached embeddings
+    global _corpus
+    _corpus = load_corpus()
+
     # Create a study object and optimize the objective function
-    study = optuna.create_study(direction='maximize')
-    study.optimize(
-        objective, 
-        n_trials=n_trials, 
-        timeout=timeout,
-        show_progress_bar=show_progress_bar
+    name = make_study_name(_corpus, resume)
+    study = optuna.create_study(
+        study_name=name,
+        storage=storage,
+        direction='maximize',
+        pruner=make_pruner(),
+        load_if_exists=resume,
     )
+
+    n_jobs = max(1, min(n_jobs, n_trials))
+    trials_per_job = [n_trials // n_jobs + (1 if i < n_trials % n_jobs else 0) for i in range(n_jobs)]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [
+            executor.submit(run_trials, name, storage, job_trials, timeout, show_progress_bar and i == 0)
+            for i, job_trials in enumerate(trials_per_job)
+        ]
+        for future in futures:
+            future.result()
     
     # Print results
     print("Best trial:")
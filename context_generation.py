@@ -1,6 +1,9 @@
 import pymupdf4llm
+import fitz
 import re
 import nltk
+from concurrent.futures import ProcessPoolExecutor
+from training_data_generation import non_body_filter
 
 # Download the Punkt tokenizer for sentence tokenization if not already downloaded
 try:
@@ -12,11 +15,99 @@ except LookupError:
 # https://pymupdf.readthedocs.io/en/latest/pymupdf4llm/
 # https://ayselaydin.medium.com/1-text-preprocessing-techniques-for-nlp-37544483c007
 
-def extract(pdf_path):
-    text = pymupdf4llm.to_markdown(pdf_path)
+# Number of pages extracted by each worker, and how many shards may be in flight at once.
+# Shards are yielded in page order, so at most EXTRACT_WORKERS * 2 shards of text are held in memory.
+PAGES_PER_SHARD = 10
+EXTRACT_WORKERS = 4
+
+# Sentences per process when bulk preprocessing is sharded across workers
+BULK_SHARD_SENTENCES = 5000
+
+# Bulk preprocessing joins all sentences with a separator that `clean` would never produce,
+# and runs each `clean` pass once over the joined text. The patterns are the ones in `clean`,
+# changed so that they cannot match across a separator, and so that each starts with a character set
+# (which lets the regex engine skip ahead to candidate positions instead of trying every position).
+SENTENCE_SEPARATOR = '\x00'
+PARAGRAPH_BREAK = re.compile(r'\n\n+')
+BULK_MARKUP = re.compile(r'(?=[#hw<\s\-])(?:#+\s[^\n\x00]*|https?://[^\s\x00]+|www\.[^\s\x00]+|<[^\n\x00]*?>|(?:^|(?<=\x00))\s*-+\s*(?:$|(?=\x00)))', re.MULTILINE)
+BULK_LOOSE_PUNCTUATION = re.compile(r"['’‑-](?:(?<!\w['’‑-])|(?!\w))")
+# Whole runs are replaced at once, which is equivalent because whitespace runs are collapsed afterwards
+BULK_NON_ALPHABETIC = re.compile(r"[^\r\na-z\s'’\-\x00]+")
+
+# Fraction of the page width treated as side margin by the plain-text backend.
+# Policy documents use narrower margins than the Easy Read documents the filter was written for.
+TEXT_SIDE_MARGIN = 0.05
+
+def extract(pdf_path, backend='markdown'):
+    text = EXTRACTION_BACKENDS[backend](pdf_path)
     return text
 
-def preprocess(text):
+def extract_pages(pdf_path, pages=None):
+    """
+    Extract the markdown text of a range of pages (0-based page numbers), or of the whole file if pages is None.
+    Runs in a worker process, so it only takes picklable arguments.
+    """
+    return pymupdf4llm.to_markdown(pdf_path, pages=None if pages is None else list(pages))
+
+def extract_text_pages(pdf_path, pages=None):
+    """
+    Lightweight alternative to `extract_pages` built on raw PyMuPDF text blocks.
+    `clean` strips markdown and tables anyway, so this skips pymupdf4llm's layout reconstruction.
+    Headers, footers and side margins are dropped with the same filter used for the training data.
+    Lines of a block are kept on separate lines and blocks are separated by a blank line,
+    so `preprocess` still treats each block as its own paragraph.
+    """
+    blocks_text = []
+    with fitz.open(pdf_path) as doc:
+        for page_num in (range(len(doc)) if pages is None else pages):
+            page = doc.load_page(page_num)
+            for block in page.get_text("dict")["blocks"]:
+                if block["type"] != 0 or not non_body_filter(block, page.rect, TEXT_SIDE_MARGIN):  # Type 0 is text
+                    continue
+                lines = ["".join(span["text"] for span in line["spans"]) for line in block["lines"]]
+                block_text = "\n".join(line for line in lines if line.strip())
+                if block_text:
+                    blocks_text.append(block_text)
+    return "\n\n".join(blocks_text)
+
+# Extraction backends selectable per job
+EXTRACTION_BACKENDS = {
+    'markdown': extract_pages,
+    'text': extract_text_pages,
+}
+
+def page_shards(pdf_path, pages_per_shard=PAGES_PER_SHARD):
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    return [range(start, min(start + pages_per_shard, page_count)) for start in range(0, page_count, pages_per_shard)]
+
+def iter_extract(pdf_path, pages_per_shard=PAGES_PER_SHARD, max_workers=EXTRACT_WORKERS, backend='markdown'):
+    """
+    Extract the PDF in page-range shards across a process pool and yield the text of each shard in page order.
+    Only a bounded number of shards are submitted ahead of the one being consumed, which keeps peak memory
+    bounded and lets the caller start working on the first pages before the last ones are extracted.
+    `backend` is one of EXTRACTION_BACKENDS.
+    """
+    extract_shard = EXTRACTION_BACKENDS[backend]
+    shards = page_shards(pdf_path, pages_per_shard)
+    if len(shards) <= 1:
+        for shard in shards:
+            yield extract_shard(pdf_path, shard)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = []
+        next_shard = 0
+        while next_shard < len(shards) or pending:
+            while next_shard < len(shards) and len(pending) < max_workers * 2:
+                pending.append(executor.submit(extract_shard, pdf_path, shards[next_shard]))
+                next_shard += 1
+            yield pending.pop(0).result()
+
+def split_sentences(text):
+    """
+    Split text into cleaned, non-empty sentences, keeping duplicates and document order.
+    """
     nltk_tokenized_sentences = nltk.sent_tokenize(text)
     sentences = []
     for sent in nltk_tokenized_sentences:
@@ -27,6 +118,10 @@ def preprocess(text):
     sentences = [subsent.strip() for sent in sentences for subsent in re.split(r'\n\n+\-', sent)]
     cleaned_sentences = [clean(sent) for sent in sentences]
     filtered_sentences = [sent for sent in cleaned_sentences if sent.strip() != ""]
+    return filtered_sentences
+
+def preprocess(text):
+    filtered_sentences = split_sentences(text)
 
     # remove duplicates
     visited = set()
@@ -38,6 +133,66 @@ def preprocess(text):
 
     return unique_sentences
 
+def iter_preprocess(texts):
+    """
+    Streaming version of `preprocess`: takes an iterable of text chunks (e.g. from `iter_extract`)
+    and yields unique cleaned sentences as soon as the chunk containing them has been processed.
+    Chunks are cleaned with the bulk path, which gives the same sentences as `preprocess`.
+    """
+    # remove duplicates across all chunks
+    visited = set()
+    for text in texts:
+        for sent in split_sentences_bulk(text):
+            if sent not in visited:
+                visited.add(sent)
+                yield sent
+
+def clean_bulk(sentences):
+    """
+    Equivalent to `[clean(sent.strip()) for sent in sentences]` for sentences without paragraph breaks,
+    but runs each regex pass once over the joined text instead of once per sentence.
+    """
+    if not sentences:
+        return []
+    text = SENTENCE_SEPARATOR.join(sent.strip() for sent in sentences)
+    if text.count(SENTENCE_SEPARATOR) != len(sentences) - 1:
+        # The separator already occurs in the text, so fall back to cleaning sentence by sentence
+        return [clean(sent.strip()) for sent in sentences]
+
+    text = text.lower()
+    text = BULK_MARKUP.sub('', text)
+    text = BULK_LOOSE_PUNCTUATION.sub('', text)
+    text = BULK_NON_ALPHABETIC.sub(' ', text)
+    # str.split() uses the same definition of whitespace as \s, and never splits on the separator
+    text = ' '.join(text.split())
+    text = text.replace(' ' + SENTENCE_SEPARATOR, SENTENCE_SEPARATOR).replace(SENTENCE_SEPARATOR + ' ', SENTENCE_SEPARATOR)
+    return text.split(SENTENCE_SEPARATOR)
+
+def split_sentences_bulk(text, workers=None):
+    """
+    Same output as `split_sentences`, using `clean_bulk`.
+    If workers is given, cleaning is sharded across that many processes.
+    """
+    if SENTENCE_SEPARATOR in text:
+        return split_sentences(text)
+
+    # Paragraph breaks become sentence separators. After this split no sentence contains \n\n,
+    # so the second `re.split` in `split_sentences` never matches and is not needed here.
+    sentences = PARAGRAPH_BREAK.split(SENTENCE_SEPARATOR.join(nltk.sent_tokenize(text)))
+    sentences = [subsent for sent in sentences for subsent in sent.split(SENTENCE_SEPARATOR)]
+
+    if workers and len(sentences) > BULK_SHARD_SENTENCES:
+        shards = [sentences[i:i + BULK_SHARD_SENTENCES] for i in range(0, len(sentences), BULK_SHARD_SENTENCES)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            cleaned_sentences = [sent for shard in executor.map(clean_bulk, shards) for sent in shard]
+    else:
+        cleaned_sentences = clean_bulk(sentences)
+    return [sent for sent in cleaned_sentences if sent]
+
+def preprocess_bulk(text, workers=None):
+    # dict keeps the first occurrence of each sentence in order
+    return list(dict.fromkeys(split_sentences_bulk(text, workers)))
+
 def clean(text):
     text = text.lower()
     # remove hashtags, urls, html tags, and lines with only dashes
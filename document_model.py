@@ -0,0 +1,96 @@
+from itertools import accumulate
+
+# Editable model of an Easy Read document: its groups (an image and its text) in reading order,
+# and for each built template, the pages those groups were actually laid out on.
+
+
+class Group:
+    """
+    One image and its Easy Read text. Unpacks as (image, text).
+    """
+    __slots__ = ('image', 'text')
+
+    def __init__(self, image, text):
+        self.image = image
+        self.text = text
+
+    def __iter__(self):
+        yield self.image
+        yield self.text
+
+
+class EasyReadDocument:
+    """
+    The groups of a document in reading order. An edit replaces the edited Group, so a build can
+    work from a snapshot (a shallow copy of the list) while the user keeps editing.
+    """
+    __slots__ = ('groups',)
+
+    def __init__(self, groups):
+        self.groups = groups
+
+    @classmethod
+    def from_results(cls, text, image_paths):
+        return cls([Group(image_paths[i][1], text[i]) for i in range(len(text))])
+
+    def snapshot(self):
+        return list(self.groups)
+
+    def set_text(self, index, text):
+        self.groups[index] = Group(self.groups[index].image, text)
+
+
+class Pagination:
+    """
+    Assignment of consecutive groups to the pages of a built document, from the number of groups
+    placed on each page, and where each group's text was drawn. Boxes are numbered from "box1" on
+    each page; finding the group of a box is O(1).
+    """
+    __slots__ = ('starts', 'rects')
+
+    def __init__(self, page_counts, rects=()):
+        # starts[p] is the index of the first group on page p + 1, and starts[-1] the number of groups placed
+        self.starts = [0, *accumulate(page_counts)]
+        # rects[i] is the (x0, y0, x1, y1) of group i's text on its page, in points from the top left
+        self.rects = list(rects)
+
+    @property
+    def page_count(self):
+        return len(self.starts) - 1
+
+    def group_index(self, page, box):
+        """
+        Returns the index of the group in box `box` ("box1", "box2", ...) of page `page` (from 1), or None.
+        """
+        if not 1 <= page <= self.page_count or not box.startswith('box') or not box[3:].isdigit():
+            return None
+        index = self.starts[page - 1] + int(box[3:]) - 1
+        return index if self.starts[page - 1] <= index < self.starts[page] else None
+
+    def boxes(self, groups, page):
+        """
+        Returns the text of each box of a page, as {"box1": text, ...}.
+        """
+        if not 1 <= page <= self.page_count:
+            return {}
+        return {
+            f"box{i - self.starts[page - 1] + 1}": groups[i].text
+            for i in range(self.starts[page - 1], self.starts[page])
+        }
+
+    def pages(self, groups):
+        """
+        Returns the boxes of every page, as [[{"id": "box1", "text": text, "rect": [x0, y0, x1, y1]}, ...], ...],
+        for clients that render the PDF themselves and overlay the boxes on it.
+        """
+        return [
+            [
+                {
+                    "id": f"box{i - self.starts[page] + 1}",
+                    "text": groups[i].text,
+                    "rect": list(self.rects[i]) if i < len(self.rects) else None,
+                }
+                for i in range(self.starts[page], self.starts[page + 1])
+            ]
+            for page in range(self.page_count)
+        ]
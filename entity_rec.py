@@ -1,13 +1,34 @@
 from openai import OpenAI
 import os
+import re
+import json
+import threading
 from dotenv import load_dotenv
 from tqdm import tqdm
+from jobs import JobCancelled, raise_if_cancelled
+from api_calls import call_api
 from typing import List, Tuple, Dict, Any, Optional
 
 
 load_dotenv()
 api_key = os.getenv('API_KEY')
-client = OpenAI(api_key=api_key)
+# Retries are handled by call_api
+client = OpenAI(api_key=api_key, max_retries=0)
+
+# Prompts are engineered concurrently by generate_images, and they all write the same history file
+history_lock = threading.Lock()
+
+# Number of sentences turned into prompts by one batched request
+PROMPT_BATCH_SIZE = 20
+# Batched prompts asking for text to be rendered are rejected, since the image must not contain text.
+# Letters, signs, forms and words as subject matter are fine ("a person opening a letter").
+TEXT_IN_IMAGE_PATTERN = re.compile(
+    r'\b(?:that|which)\s+(?:says|said|reads)\b|\bsaying\b|\bspell(?:ing|ed|s)? out\b'
+    r'|\bwith the (?:words?|text|letters?|caption)\b|\b(?:words?|text|caption|title|heading)\s*:?\s*["“\']'
+    r'|\bcaption(?:ed)?\b|\blabell?ed (?:with|as)\b|\bwritten (?:on|across)\b|\btypography\b|\bfont\b'
+    r'|["“][^"”]+["”]',
+    re.IGNORECASE)
+MAX_PROMPT_WORDS = 60
 
 
 def get_refinement_criteria() -> str:
@@ -28,7 +49,7 @@ def get_refinement_criteria() -> str:
 
 
 def refine_translation(client: OpenAI, current_text: str, original_input: str, 
-                        model: str = "gpt-4-turbo") -> Tuple[str, Dict[str, Any]]:
+                        model: str = "gpt-4-turbo", cancel_token=None) -> Tuple[str, Dict[str, Any]]:
     """Refine the given prompt based on evaluation criteria."""
     refinement_prompt = f"""Original Text: {original_input}
 
@@ -38,42 +59,50 @@ def refine_translation(client: OpenAI, current_text: str, original_input: str,
     {get_refinement_criteria()}"""
 
     try:
-        response = client.chat.completions.create(
+        response = call_api('chat', lambda timeout: client.chat.completions.create(
             model=model,
             messages=[
                 {"role": "system", "content": "You are an expert in converting plain text to clear and concise prompts for diffusion model use."},
                 {"role": "user", "content": refinement_prompt}
             ],
             temperature=0.7,
-            max_tokens=2000
-        )
+            max_tokens=2000,
+            timeout=timeout
+        ), cancel_token=cancel_token)
         
         feedback = response.choices[0].message.content
         improved_text = feedback.split("improved version")[-1].strip()
         
         return improved_text, {"full_feedback": feedback}
     
+    except JobCancelled:
+        raise
     except Exception as e:
         print(f"Error in refinement: {str(e)}")
         return current_text, {"error": str(e)}
 
 
 def iterative_translation(input_text: str, n_iterations: int = 3, 
-                         model: str = "gpt-4-turbo") -> List[Tuple[str, Dict[str, Any]]]:
+                         model: str = "gpt-4-turbo", cancel_token=None) -> List[Tuple[str, Dict[str, Any]]]:
     
     system_prompt = f"You are an expert in converting plain text to clear and concise prompts for diffusion model use."
     
+    raise_if_cancelled(cancel_token)
     try:
-        response = client.chat.completions.create(
+        # Deterministic (temperature 0), so a hedged duplicate is harmless
+        response = call_api('chat', lambda timeout: client.chat.completions.create(
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": input_text}
             ],
             temperature=0,
             max_tokens=2000,
-            model=model
-        )
+            model=model,
+            timeout=timeout
+        ), idempotent=True, cancel_token=cancel_token)
         current_text = response.choices[0].message.content
+    except JobCancelled:
+        raise
     except Exception as e:
         print(f"Error in initial translation: {str(e)}")
         return []
@@ -82,12 +111,15 @@ def iterative_translation(input_text: str, n_iterations: int = 3,
     
     # Refinement loop
     for i in tqdm(range(n_iterations), desc="Refining translation"):
+        # A cancelled job stops before its next request rather than finishing the loop
+        raise_if_cancelled(cancel_token)
         try:
             refined_text, feedback = refine_translation(
                 client=client,
                 current_text=current_text,
                 original_input=input_text,
-                model=model
+                model=model,
+                cancel_token=cancel_token
             )
             
             results.append((refined_text, {
@@ -96,6 +128,8 @@ def iterative_translation(input_text: str, n_iterations: int = 3,
             }))
             current_text = refined_text
             
+        except JobCancelled:
+            raise
         except Exception as e:
             print(f"Error in iteration {i+1}: {str(e)}")
             break
@@ -106,7 +140,7 @@ def iterative_translation(input_text: str, n_iterations: int = 3,
 def save_refinement_history(results: List[Tuple[str, Dict[str, Any]]], filename: str = "translation_history.txt") -> Optional[str]:
     last_quoted_line = None
     
-    with open(filename, 'w', encoding='utf-8') as f:
+    with history_lock, open(filename, 'w', encoding='utf-8') as f:
         f.write("=== Translation Refinement History ===\n\n")
         for i, (text, metadata) in enumerate(results):
             f.write(f"\n--- Stage: {metadata['stage']} ---\n")
@@ -135,9 +169,79 @@ def save_refinement_history(results: List[Tuple[str, Dict[str, Any]]], filename:
     return last_quoted_line
 
 
-def translate(input_text):
+def get_batch_instructions() -> str:
+    return """Convert each numbered sentence into a prompt for a diffusion model that illustrates it.
+    Each prompt must:
+    1. Keep the meaning of its sentence.
+    2. Describe a single simple scene with simple geometry and few details.
+    3. Not ask for any text, words, letters, labels or signs in the image.
+    4. Be at most 40 words.
+
+    Respond with a JSON object of the form {"prompts": ["prompt for sentence 1", "prompt for sentence 2", ...]},
+    with exactly one prompt per sentence, in the same order."""
+
+
+def validate_prompt(prompt: Any) -> bool:
+    """Check a batched prompt against the same constraints the refinement loop enforces."""
+    if not isinstance(prompt, str) or not prompt.strip():
+        return False
+    if len(prompt.split()) > MAX_PROMPT_WORDS:
+        return False
+    return TEXT_IN_IMAGE_PATTERN.search(prompt) is None
+
+
+def batch_prompts(sentences: List[str], model: str = "gpt-4-turbo", cancel_token=None) -> List[Optional[str]]:
+    """Turn a batch of sentences into diffusion prompts with one structured request.
+    Returns one prompt per sentence, or None where the response had no valid prompt for it."""
+    numbered = "\n".join(f"{i + 1}. {sentence}" for i, sentence in enumerate(sentences))
+
+    try:
+        response = call_api('chat_batch', lambda timeout: client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": "You are an expert in converting plain text to clear and concise prompts for diffusion model use."},
+                {"role": "user", "content": f"{get_batch_instructions()}\n\nSentences:\n{numbered}"}
+            ],
+            response_format={"type": "json_object"},
+            temperature=0,
+            max_tokens=4000,
+            timeout=timeout
+        ), idempotent=True, cancel_token=cancel_token)
+        prompts = json.loads(response.choices[0].message.content).get("prompts", [])
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print(f"Error in batched prompt generation: {str(e)}")
+        return [None] * len(sentences)
+
+    if not isinstance(prompts, list) or len(prompts) != len(sentences):
+        # The prompts cannot be matched to their sentences, so none of them can be used
+        print(f"Batched prompt generation returned {len(prompts) if isinstance(prompts, list) else 'no'} prompts for {len(sentences)} sentences")
+        return [None] * len(sentences)
+
+    return [prompt.strip() if validate_prompt(prompt) else None for prompt in prompts]
+
+
+def translate_batch(sentences: List[str], batch_size: int = PROMPT_BATCH_SIZE, fallback: bool = True,
+                    cancel_token=None) -> List[Optional[str]]:
+    """Turn all of a document's sentences into diffusion prompts in a few batched requests.
+    Sentences whose batched prompt fails validation go through the per-sentence refinement loop,
+    or are returned as None if `fallback` is False so the caller can run that loop itself."""
+    prompts = []
+    for start in range(0, len(sentences), batch_size):
+        raise_if_cancelled(cancel_token)
+        prompts.extend(batch_prompts(sentences[start:start + batch_size], cancel_token=cancel_token))
+
+    if fallback:
+        for i, prompt in enumerate(prompts):
+            if prompt is None:
+                prompts[i] = translate(sentences[i], cancel_token)
+    return prompts
+
+
+def translate(input_text, cancel_token=None):
     # Run iterative translation
-    results = iterative_translation(input_text, n_iterations=3)
+    results = iterative_translation(input_text, n_iterations=3, cancel_token=cancel_token)
     opt = save_refinement_history(results)
 
     return opt
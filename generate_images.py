@@ -1,63 +1,318 @@
-from openai import OpenAI  # OpenAI Python library to make API calls
-import requests  # used to download images
 import os  # used to access filepaths
-from entity_rec import translate
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from entity_rec import translate, translate_batch, batch_prompts
+from image_backends import get_image_backend
+from image_cache import ImageCache, CACHE_DIR, content_key, normalize_sentence
+from image_library import ImageLibrary
+from jobs import JobCancelled, raise_if_cancelled
+from artifacts import publish_file
 from PIL import Image  # used to print and edit images
 from io import BytesIO
-from dotenv import load_dotenv
-
-load_dotenv()
-api_key = os.getenv('API_KEY')
-client = OpenAI(api_key=api_key)
 
 # Set a directory to save DALL-E images to
 image_dir = "app/static/images"
 
+# Maximum number of prompts processed at once (prompt engineering and image request)
+MAX_CONCURRENT_IMAGES = 4
+# Threads decoding, resizing and saving received images, off the request threads
+INGEST_WORKERS = 2
+IMAGE_SIZE = (512, 512)
+# Seconds between checks of the job's cancel token while waiting for images
+CANCEL_POLL_INTERVAL = 0.5
+# Sentences streamed out of the translation are turned into prompts in batches of this size
+PREFETCH_BATCH_SIZE = 5
+# Whether prefetching also generates the images of streamed sentences. Off by default, since every
+# image is billed and a streamed sentence is not final until the translation is.
+PREFETCH_GENERATE = False
+
 # Create the directory if it doesn't yet exist
 if not os.path.isdir(image_dir):
     os.mkdir(image_dir)
 
+# Backend generating the images, chosen by the IMAGE_BACKEND environment variable (see image_backends)
+image_backend = get_image_backend()
+
+# Images already generated for a sentence or prompt, shared across documents.
+# Each backend gets its own cache, so placeholder images never replace real ones.
+image_cache = ImageCache(os.path.join(CACHE_DIR, image_backend.name))
+# Approved images (past outputs and curated pictograms) reused for semantically similar sentences
+image_library = ImageLibrary()
+
+# Batches of sentences streamed out of the translation, prepared ahead of generate_images_from_prompts.
+# `prefetches` maps each normalized sentence to the Future of its batch, which the final pass waits for;
+# `prefetch_queue` holds the sentences waiting for a full batch. Prompts engineered for sentences whose
+# image is not cached are kept in `prefetched_prompts`, so the final pass does not engineer them again.
+prefetch_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_IMAGES)
+prefetches = {}
+prefetch_queue = []
+prefetched_prompts = {}
+prefetch_lock = threading.Lock()
+
+def save_image(image_bytes, generated_image_filepath):
+    img = Image.open(BytesIO(image_bytes))
+    # Decode JPEGs straight at reduced scale (no effect on PNGs, which DALL-E usually returns)
+    img.draft("RGB", IMAGE_SIZE)
+    img = img.convert("RGB")
+    if img.size != IMAGE_SIZE:
+        # reducing_gap shrinks by an integer factor first, then applies LANCZOS to the smaller image
+        img = img.resize(IMAGE_SIZE, Image.LANCZOS, reducing_gap=2.0)
+
+    # Save the image once, at its final size
+    img.save(generated_image_filepath)
+
+def remember_image(base_prompt, engineered_prompt, generated_image_filepath):
+    # Add a newly generated image to the cache, and to the library if the backend's images are worth reusing
+    image_cache.store(base_prompt, engineered_prompt, generated_image_filepath)
+    if image_backend.reusable:
+        try:
+            image_library.add(base_prompt, generated_image_filepath)
+        except Exception as e:
+            print(f"Warning: Could not add {generated_image_filepath} to the image library. Error: {e}")
+
+def discard_if_cancelled(generated_image_filepath, cancel_token):
+    # A cancelled job's files are never published, so they are removed here rather than left behind
+    if cancel_token is not None and cancel_token.cancelled:
+        os.remove(generated_image_filepath)
+        raise JobCancelled()
+
+def ingest_image(generated_image_filepath, base_prompt, engineered_prompt, image_bytes, cancel_token=None):
+    """
+    Decode, resize and save a generated image to the job's file for it, then add it to the cache and library.
+    Returns the engineered prompt, the image path and the time spent ingesting.
+    """
+    start = time.perf_counter()
+    save_image(image_bytes, generated_image_filepath)
+    elapsed = time.perf_counter() - start
+    discard_if_cancelled(generated_image_filepath, cancel_token)
+
+    remember_image(base_prompt, engineered_prompt, generated_image_filepath)
+    return engineered_prompt, generated_image_filepath, elapsed
+
+def request_image(generated_image_filepath, base_prompt, engineered_prompt, ingest_executor, cancel_token=None):
+    """
+    Request the image for one sentence. `engineered_prompt` comes from the batched prompt generation;
+    if it is None the prompt is engineered here with the per-sentence refinement loop.
+    Prompts seen before are served from the image cache, and the engineered prompt and image path
+    are returned. Otherwise the received image is handed to `ingest_executor` and the Future of
+    `ingest_image` is returned, so this thread can move on to the next request.
+    Raises JobCancelled instead of issuing a request once `cancel_token` is cancelled.
+    """
+    # Engineer the prompt
+    raise_if_cancelled(cancel_token)
+    if engineered_prompt is None:
+        engineered_prompt = translate(base_prompt, cancel_token) if image_backend.needs_prompt_engineering else base_prompt
+    engineered_prompt = engineered_prompt + " Style: photorealistic."
+
+    if image_cache.lookup_prompt(engineered_prompt, generated_image_filepath):
+        discard_if_cancelled(generated_image_filepath, cancel_token)
+        image_cache.store(base_prompt, engineered_prompt, generated_image_filepath)
+        return engineered_prompt, generated_image_filepath
+
+    # Generate the image with the configured backend
+    raise_if_cancelled(cancel_token)
+    image_bytes = image_backend.generate(engineered_prompt, cancel_token)
+
+    return ingest_executor.submit(ingest_image, generated_image_filepath, base_prompt, engineered_prompt, image_bytes, cancel_token)
+
+def cache_images(sentences, cancel_token=None):
+    """
+    Prepare the images of a batch of sentences that are neither cached nor in the library: engineer
+    their prompts in one batched request, and link each sentence to the cached image of its prompt.
+    Prompts without a cached image are kept for the final pass, or generated into the cache with PREFETCH_GENERATE.
+    Lookups are not counted in the cache and library statistics, since the final pass looks the sentences up again.
+    """
+    raise_if_cancelled(cancel_token)
+    sentences = [sentence for sentence in sentences if image_cache.lookup_sentence(sentence, count=False) is None]
+    try:
+        sentences = [sentence for sentence, match in zip(sentences, image_library.lookup_many(sentences, count=False))
+                     if match is None]
+    except Exception as e:
+        print(f"Warning: Image library lookup failed. Error: {e}")
+    if not sentences:
+        return
+
+    prompts = batch_prompts(sentences, cancel_token=cancel_token) if image_backend.needs_prompt_engineering else sentences
+    for sentence, prompt in zip(sentences, prompts):
+        # Sentences without a valid prompt are left to the final pass
+        if prompt is None:
+            continue
+        engineered_prompt = prompt + " Style: photorealistic."
+        if image_cache.store_sentence(sentence, engineered_prompt, count=False):
+            continue
+        if not PREFETCH_GENERATE:
+            with prefetch_lock:
+                prefetched_prompts[normalize_sentence(sentence)] = prompt
+            continue
+
+        raise_if_cancelled(cancel_token)
+        image_bytes = image_backend.generate(engineered_prompt, cancel_token)
+        prefetch_image_filepath = os.path.join(image_dir, f"prefetch_{content_key(engineered_prompt)[:16]}.jpg")
+        save_image(image_bytes, prefetch_image_filepath)
+        remember_image(sentence, engineered_prompt, prefetch_image_filepath)
+        os.remove(prefetch_image_filepath)
+
+def prefetch_image(sentence, cancel_token=None):
+    """
+    Queue a sentence streamed out of the translation, and return straight away. Every PREFETCH_BATCH_SIZE
+    sentences are prepared together by cache_images, so that generate_images_from_prompts finds them ready.
+    """
+    key = normalize_sentence(sentence)
+    with prefetch_lock:
+        if key in prefetches or any(normalize_sentence(queued) == key for queued in prefetch_queue):
+            return
+        prefetch_queue.append(sentence)
+        if len(prefetch_queue) < PREFETCH_BATCH_SIZE:
+            return
+        batch = prefetch_queue[:]
+        del prefetch_queue[:]
+        future = prefetch_executor.submit(cache_images, batch, cancel_token)
+        keys = [normalize_sentence(queued) for queued in batch]
+        for queued_key in keys:
+            prefetches[queued_key] = future
+    future.add_done_callback(lambda _: finish_prefetch(keys))
+
+def finish_prefetch(keys):
+    with prefetch_lock:
+        for key in keys:
+            future = prefetches.pop(key)
+    error = future.exception()
+    # A failed prefetch is only a cache miss; the image pass prepares the images again
+    if error is not None and not isinstance(error, JobCancelled):
+        print(f"Warning: Could not prefetch the images of {len(keys)} sentences. Error: {error}")
+
+def save_placeholder_image(generated_image_filepath):
+    # Blank image used when generation fails, so the document can still be laid out
+    Image.new("RGB", IMAGE_SIZE, (255, 255, 255)).save(generated_image_filepath)
+    return generated_image_filepath
+
 # Function to generate images from a list of prompts
-def generate_images_from_prompts(prompts, progress_callback=None):
-    images = []
-    docx = []
+def generate_images_from_prompts(prompts, progress_callback=None, max_workers=MAX_CONCURRENT_IMAGES, cancel_token=None):
+    """
+    Generate one image per prompt, running up to `max_workers` prompts concurrently.
+    Prompts similar enough to a sentence in the image library reuse its image without any API call.
+    Results are returned in prompt order, each image renamed to section_{i}.<content hash>.jpg once done.
+    A prompt whose image fails gets a blank placeholder image instead of aborting the document. `progress_callback(completed, total)` is called as each prompt finishes.
+    Once `cancel_token` is cancelled, queued prompts are dropped, requests in flight are left to
+    finish in the background and JobCancelled is raised within CANCEL_POLL_INTERVAL seconds.
+    Images are written to temporary files unique to this call, so requests a cancelled job left
+    running never overwrite the images of the next one.
+    """
     total_prompts = len(prompts)
+    images = [None] * total_prompts
+    docx = [None] * total_prompts
+    ingestion_times = []
+
+    completed = 0
+    job_id = uuid.uuid4().hex
+
+    def image_path(i):
+        return os.path.join(image_dir, f"section_{i}.{job_id}.jpg")
+
+    def finish(i, engineered_prompt, generated_image_filepath):
+        nonlocal completed
+        # Named by content, so a new image for the same section never reuses a URL a browser has cached
+        generated_image_filepath = publish_file(generated_image_filepath, f"section_{i}.jpg")
+        images[i] = (engineered_prompt, generated_image_filepath)
+        docx[i] = {'image_path': generated_image_filepath, 'text': prompts[i]}
 
-    for i, base_prompt in enumerate(prompts):
-        # Engineer the prompt
-        engineered_prompt = translate(base_prompt) + " Style: photorealistic."
-
-        # Generate the image using the OpenAI API
-        generation_response = client.images.generate(
-            model="dall-e-3",
-            prompt=engineered_prompt,
-            n=1,
-            size="1024x1024",
-            response_format="url",
-        )
-
-        # Extract the image URL from the response
-        generated_image_url = generation_response.data[0].url
-
-        # Download the image
-        img_response = requests.get(generated_image_url)
-        img = Image.open(BytesIO(img_response.content))
-
-        # Resize to 512x512
-        img = img.resize((512, 512), Image.LANCZOS)
-
-        # Define a unique name for each generated image
-        generated_image_name = f"section_{i}.jpg"
-        generated_image_filepath = os.path.join(image_dir, generated_image_name)
-
-        # Save the resized image
-        img.save(generated_image_filepath)
-        
-        images.append((engineered_prompt, generated_image_filepath))
-        docx.append({'image_path':generated_image_filepath, 'text': base_prompt})
-        
-        # Update the progress
+        # Update the progress with the number of prompts finished so far, in whatever order they finish
+        completed += 1
         if progress_callback:
-            progress_callback(i +1, total_prompts)
+            progress_callback(completed, total_prompts)
+
+    # Let batches already being prefetched for these sentences finish, so they are not prepared twice.
+    # Sentences still waiting for a full batch are prepared below with the rest.
+    with prefetch_lock:
+        del prefetch_queue[:]
+        running = {prefetches[key] for key in {normalize_sentence(prompt) for prompt in prompts} if key in prefetches}
+    wait(running)
+    with prefetch_lock:
+        ready_prompts = {key: prefetched_prompts.pop(key) for key in {normalize_sentence(prompt) for prompt in prompts}
+                         if key in prefetched_prompts}
+        # Prompts of sentences that did not make it into the final translation are no use any more
+        prefetched_prompts.clear()
+
+    # One batched embedding and similarity search for the whole document
+    try:
+        library_matches = image_library.lookup_many(prompts)
+    except Exception as e:
+        print(f"Warning: Image library lookup failed. Error: {e}")
+        library_matches = [None] * total_prompts
+
+    to_generate = []
+    for i, match in enumerate(library_matches):
+        generated_image_filepath = image_path(i)
+        if match is not None:
+            engineered_prompt = None
+            try:
+                shutil.copyfile(match[0], generated_image_filepath)
+            except OSError as e:
+                # A missing or unreadable library file is a library miss; the sentence is generated instead
+                print(f"Warning: Could not copy library image {match[0]}. Error: {e}")
+                match = None
+        if match is None:
+            # A sentence seen before skips both prompt engineering and image generation
+            engineered_prompt = image_cache.lookup_sentence(prompts[i], generated_image_filepath)
+            if engineered_prompt is None:
+                to_generate.append(i)
+                continue
+        finish(i, engineered_prompt, generated_image_filepath)
+
+    # Engineer the prompts of the remaining sentences in a few batched requests, unless they were
+    # engineered while the translation streamed. Sentences whose batched prompt is invalid get None
+    # and are refined one by one in request_image.
+    engineered_prompts = [ready_prompts.get(normalize_sentence(prompts[i])) for i in to_generate]
+    missing = [j for j, engineered_prompt in enumerate(engineered_prompts) if engineered_prompt is None]
+    if image_backend.needs_prompt_engineering and missing:
+        try:
+            batched = translate_batch([prompts[to_generate[j]] for j in missing], fallback=False, cancel_token=cancel_token)
+            for j, engineered_prompt in zip(missing, batched):
+                engineered_prompts[j] = engineered_prompt
+        except JobCancelled:
+            raise
+        except Exception as e:
+            print(f"Warning: Batched prompt generation failed. Error: {e}")
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS)
+    try:
+        # Maps request futures, and the ingestion futures they hand over, to their prompt index
+        pending = {
+            executor.submit(request_image, image_path(i), prompts[i], engineered_prompt, ingest_executor, cancel_token): i
+            for i, engineered_prompt in zip(to_generate, engineered_prompts)
+        }
+
+        while pending:
+            done, _ = wait(pending, timeout=CANCEL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            raise_if_cancelled(cancel_token)
+            for future in done:
+                i = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error generating image {i}: {e}")
+                    finish(i, None, save_placeholder_image(image_path(i)))
+                    continue
+
+                if isinstance(result, Future):
+                    pending[result] = i
+                    continue
+                if len(result) == 3:
+                    ingestion_times.append(result[2])
+                finish(i, result[0], result[1])
+    finally:
+        # A cancelled job does not wait for its requests in flight, and its queued requests are never started
+        cancelled = cancel_token is not None and cancel_token.cancelled
+        executor.shutdown(wait=not cancelled, cancel_futures=cancelled)
+        ingest_executor.shutdown(wait=not cancelled)
+
+    if ingestion_times:
+        print(f"Image ingestion: {len(ingestion_times)} images, "
+              f"mean {1000 * sum(ingestion_times) / len(ingestion_times):.1f}ms, "
+              f"max {1000 * max(ingestion_times):.1f}ms")
 
-    return images, docx
\ No newline at end of file
+    return images, docx
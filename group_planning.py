@@ -0,0 +1,139 @@
+import numpy as np
+import tiktoken
+
+# Planning stage between clustering and translation. Every translation input costs a full
+# translate() call (an initial translation and three refinements), so tiny clusters are merged
+# into their nearest neighbour, near-identical sentences are only translated once, and groups
+# are packed together up to a target size before translation.
+
+# Clusters with fewer sentences than this are merged into their nearest cluster
+MIN_GROUP_SIZE = 4
+# Sentences whose embeddings are at least this similar to a sentence in an earlier group are dropped
+DUPLICATE_THRESHOLD = 0.92
+# Groups are packed into translation inputs of at most this many tokens (a larger group stays on its own)
+TARGET_TOKENS = 400
+
+
+def merge_small_groups(groups, group_embeddings, min_size=MIN_GROUP_SIZE):
+    """
+    Repeatedly merge the smallest group with fewer than `min_size` sentences into the group
+    whose centroid is most similar, until no group is undersized or only one group remains.
+
+    Parameters:
+    - groups: List of groups, each a list of sentences.
+    - group_embeddings: List of arrays, the normalized embedding of each sentence of each group.
+    - min_size: Minimum number of sentences in a group.
+
+    Returns:
+    - The merged groups and their embeddings, in the order of the original groups, and the number of merges.
+    """
+    groups = [list(group) for group in groups]
+    group_embeddings = [np.asarray(emb) for emb in group_embeddings]
+    merges = 0
+
+    while len(groups) > 1:
+        sizes = [len(group) for group in groups]
+        smallest = int(np.argmin(sizes))
+        if sizes[smallest] >= min_size:
+            break
+
+        centroids = np.vstack([emb.mean(axis=0) for emb in group_embeddings])
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+        similarity = centroids @ centroids[smallest]
+        similarity[smallest] = -np.inf
+        nearest = int(np.argmax(similarity))
+
+        groups[nearest].extend(groups[smallest])
+        group_embeddings[nearest] = np.vstack([group_embeddings[nearest], group_embeddings[smallest]])
+        del groups[smallest]
+        del group_embeddings[smallest]
+        merges += 1
+
+    return groups, group_embeddings, merges
+
+
+def drop_cross_group_duplicates(groups, group_embeddings, threshold=DUPLICATE_THRESHOLD):
+    """
+    Drop sentences that are near-duplicates of a sentence in an earlier group.
+    Sentences within the same group are left alone, since the translation of that group handles them together.
+
+    Returns:
+    - The groups without the duplicates (empty groups removed) and the number of sentences dropped.
+    """
+    if len(groups) < 2:
+        return groups, 0
+
+    # Kept sentences of the groups seen so far, in the first `n_kept` rows. Each group is only
+    # compared with these, so memory grows with the group size times the sentence count, not its square.
+    kept_embeddings = np.empty((sum(len(group) for group in groups), group_embeddings[0].shape[1]),
+                               dtype=group_embeddings[0].dtype)
+    n_kept = 0
+    deduplicated = []
+    dropped = 0
+    for group, embeddings in zip(groups, group_embeddings):
+        keep = np.ones(len(group), dtype=bool)
+        if n_kept:
+            keep = ~((embeddings @ kept_embeddings[:n_kept].T) >= threshold).any(axis=1)
+        n_group_kept = int(keep.sum())
+        kept_embeddings[n_kept:n_kept + n_group_kept] = embeddings[keep]
+        n_kept += n_group_kept
+        dropped += len(group) - n_group_kept
+        kept = [sentence for sentence, k in zip(group, keep) if k]
+        if kept:
+            deduplicated.append(kept)
+    return deduplicated, dropped
+
+
+def bucket_groups(groups, target_tokens=TARGET_TOKENS, tokenizer=None):
+    """
+    Pack consecutive groups into translation inputs of at most `target_tokens` tokens.
+
+    Returns:
+    - List of translation inputs, each the sentences of one or more groups joined with spaces.
+    """
+    if tokenizer is None:
+        tokenizer = tiktoken.get_encoding("cl100k_base")
+
+    buckets = []
+    bucket = []
+    tokens_so_far = 0
+    for group in groups:
+        text = " ".join(group)
+        n_tokens = len(tokenizer.encode(" " + text))
+        if bucket and tokens_so_far + n_tokens > target_tokens:
+            buckets.append(" ".join(bucket))
+            bucket = []
+            tokens_so_far = 0
+        bucket.append(text)
+        tokens_so_far += n_tokens
+    if bucket:
+        buckets.append(" ".join(bucket))
+    return buckets
+
+
+def plan_translation(groups, sentences, embeddings, min_size=MIN_GROUP_SIZE,
+                     threshold=DUPLICATE_THRESHOLD, target_tokens=TARGET_TOKENS):
+    """
+    Turn the clusters from `cluster_sentences` into the inputs of the translate() calls.
+
+    Parameters:
+    - groups: List of groups, each a list of sentences.
+    - sentences: The clustered sentences, in the order of `embeddings`.
+    - embeddings: Normalized embedding of each sentence.
+
+    Returns:
+    - List of translation inputs, one per translate() call.
+    """
+    row = {sentence: i for i, sentence in enumerate(sentences)}
+    embeddings = np.asarray(embeddings)
+    group_embeddings = [embeddings[[row[sentence] for sentence in group]] for group in groups if group]
+    groups = [group for group in groups if group]
+
+    merged, merged_embeddings, merges = merge_small_groups(groups, group_embeddings, min_size)
+    deduplicated, dropped = drop_cross_group_duplicates(merged, merged_embeddings, threshold)
+    translation_inputs = bucket_groups(deduplicated, target_tokens)
+
+    print(f"Translation plan: {len(groups)} clusters -> {len(translation_inputs)} translate calls "
+          f"(saved {len(groups) - len(translation_inputs)}); merged {merges} small clusters, "
+          f"dropped {dropped} near-duplicate sentences")
+    return translation_inputs
@@ -0,0 +1,128 @@
+import base64
+import hashlib
+import os
+import random
+import time
+from io import BytesIO
+import requests
+from requests.adapters import HTTPAdapter
+from openai import OpenAI
+from PIL import Image, ImageDraw
+from dotenv import load_dotenv
+from api_calls import call_api
+from jobs import JobCancelled
+
+# Image generation backends. generate_images picks one by configuration:
+#   IMAGE_BACKEND=openai (default)  DALL-E 3 through the OpenAI API
+#   IMAGE_BACKEND=local             deterministic placeholder images, for load testing and benchmarks
+# The local backend takes IMAGE_BACKEND_LATENCY (seconds per image) and IMAGE_BACKEND_ERROR_RATE (0 to 1).
+
+load_dotenv()
+
+
+class ImageBackendError(Exception):
+    pass
+
+
+class OpenAIImageBackend:
+    name = "openai"
+    # Sentences are turned into diffusion prompts before being sent to this backend
+    needs_prompt_engineering = True
+    # Its images are real outputs, worth adding to the image library
+    reusable = True
+
+    def __init__(self, response_format="b64_json", max_connections=4):
+        # Retries are handled by call_api
+        self.client = OpenAI(api_key=os.getenv('API_KEY'), max_retries=0)
+        # "b64_json" returns the image in the response itself; "url" needs a second download
+        self.response_format = response_format
+        # Pooled connections for downloading images when the API returns URLs
+        self.http_session = requests.Session()
+        self.http_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
+
+    def generate(self, prompt, cancel_token=None):
+        """
+        Generate a 1024x1024 image for the prompt and return its encoded bytes.
+        Retries stop once `cancel_token` is cancelled.
+        """
+        # Not idempotent: every request is billed and returns a different image, so it is never hedged
+        generation_response = call_api('images', lambda timeout: self.client.images.generate(
+            model="dall-e-3",
+            prompt=prompt,
+            n=1,
+            size="1024x1024",
+            response_format=self.response_format,
+            timeout=timeout,
+        ), cancel_token=cancel_token)
+        image_data = generation_response.data[0]
+        if image_data.b64_json is not None:
+            return base64.b64decode(image_data.b64_json)
+        return call_api('image_download', lambda timeout: self.download(image_data.url, timeout), idempotent=True,
+                        cancel_token=cancel_token)
+
+    def download(self, url, timeout):
+        img_response = self.http_session.get(url, timeout=timeout)
+        img_response.raise_for_status()
+        return img_response.content
+
+
+class LocalImageBackend:
+    """
+    Stand-in for the image API that needs no network access. Each prompt always gets the same
+    placeholder image, after `latency` seconds (plus up to `jitter` seconds), and a fraction
+    `error_rate` of prompts fail with ImageBackendError. The jitter and failures are drawn from a
+    generator seeded with `seed` and the prompt, so a run fails the same prompts whatever the order
+    the threads send them in.
+    """
+    name = "local"
+    needs_prompt_engineering = False
+    reusable = False
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, size=(1024, 1024), seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.size = size
+        self.seed = seed
+
+    def generate(self, prompt, cancel_token=None):
+        draw_random = random.Random(f"{self.seed}:{prompt}")
+        delay = self.latency + draw_random.uniform(0, self.jitter)
+        fail = draw_random.random() < self.error_rate
+        # Waits on the job's cancel token, so a cancelled job stops as soon as it would with the real API
+        if cancel_token is None:
+            time.sleep(delay)
+        elif cancel_token.wait(delay):
+            raise JobCancelled()
+        if fail:
+            raise ImageBackendError(f"Simulated image generation failure for prompt: {prompt[:40]}")
+
+        digest = hashlib.sha256(prompt.encode('utf-8')).digest()
+        background = tuple(128 + b // 2 for b in digest[:3])
+        foreground = tuple(b // 2 for b in digest[3:6])
+        img = Image.new("RGB", self.size, background)
+        draw = ImageDraw.Draw(img)
+        width, height = self.size
+        margin = width // 4 + digest[6] % (width // 8)
+        draw.ellipse([margin, margin, width - margin, height - margin], fill=foreground)
+
+        buffer = BytesIO()
+        img.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+
+def get_image_backend(name=None, **kwargs):
+    """
+    Create the configured image backend. `name` defaults to the IMAGE_BACKEND environment variable.
+    """
+    name = name or os.getenv('IMAGE_BACKEND', 'openai')
+    if name == "openai":
+        return OpenAIImageBackend(**kwargs)
+    if name == "local":
+        options = {
+            'latency': float(os.getenv('IMAGE_BACKEND_LATENCY', 0.0)),
+            'error_rate': float(os.getenv('IMAGE_BACKEND_ERROR_RATE', 0.0)),
+        }
+        options.update(kwargs)
+        return LocalImageBackend(**options)
+    raise ValueError(f"Unknown image backend: {name}")
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+# Content-addressed cache of generated images, shared by every document.
+# Images are stored once per engineered prompt, and each base sentence remembers the prompt it was
+# engineered into, so a repeated sentence skips both the prompt engineering and the image request.
+
+CACHE_DIR = "app/static/image_cache"
+# Least recently used images are evicted once the cache grows past this size
+MAX_CACHE_BYTES = 500 * 1024 * 1024
+
+
+def normalize_sentence(sentence):
+    # Case, surrounding punctuation and whitespace do not change the image a sentence should get
+    sentence = re.sub(r'\s+', ' ', sentence.lower()).strip()
+    return sentence.strip(' .!?,;:"\'')
+
+
+def content_key(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ImageCache:
+    """
+    Disk cache of generated images keyed by normalized base sentence and by engineered prompt,
+    with size-bounded LRU eviction. Safe to use from several threads.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock = threading.Lock()
+        self.counts = {'sentence_hits': 0, 'prompt_hits': 0, 'misses': 0}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # sentences: sentence key -> {"prompt": engineered prompt, "prompt_key": prompt key}
+        # images: prompt key -> {"file": filename, "size": bytes, "last_used": timestamp}
+        self.index = {'sentences': {}, 'images': {}}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Warning: Could not read image cache index, starting empty. Error: {e}")
+
+    def _image_path(self, prompt_key):
+        entry = self.index['images'].get(prompt_key)
+        if entry is None:
+            return None
+        path = os.path.join(self.directory, entry['file'])
+        if not os.path.exists(path):
+            del self.index['images'][prompt_key]
+            return None
+        entry['last_used'] = time.time()
+        return path
+
+    def _copy(self, prompt_key, path, destination):
+        # Called with the lock held, so a concurrent store cannot evict the image while it is copied
+        if destination is None:
+            return True
+        try:
+            shutil.copyfile(path, destination)
+            return True
+        except FileNotFoundError:
+            del self.index['images'][prompt_key]
+            return False
+
+    def lookup_sentence(self, sentence, destination=None, count=True):
+        """
+        Copies the cached image of a sentence seen before to `destination`, if given.
+        Returns its engineered prompt, or None if the sentence is not cached.
+        Lookups made ahead of the request, such as prefetching, pass count=False.
+        """
+        with self.lock:
+            entry = self.index['sentences'].get(content_key(normalize_sentence(sentence)))
+            if entry is None:
+                return None
+            path = self._image_path(entry['prompt_key'])
+            if path is None or not self._copy(entry['prompt_key'], path, destination):
+                return None
+            if count:
+                self.counts['sentence_hits'] += 1
+            return entry['prompt']
+
+    def lookup_prompt(self, prompt, destination):
+        """
+        Copies the cached image of an engineered prompt to `destination`. Returns whether it was cached.
+        Call this after `lookup_sentence` missed, so each request is counted once.
+        """
+        with self.lock:
+            prompt_key = content_key(prompt)
+            path = self._image_path(prompt_key)
+            found = path is not None and self._copy(prompt_key, path, destination)
+            self.counts['prompt_hits' if found else 'misses'] += 1
+            return found
+
+    def store_sentence(self, sentence, prompt, count=True):
+        """
+        Remember that a sentence was engineered into a prompt whose image is already cached.
+        Returns False, without remembering it, if the prompt's image is not cached.
+        Call this after `lookup_sentence` missed, so each request is counted once.
+        """
+        with self.lock:
+            prompt_key = content_key(prompt)
+            found = self._image_path(prompt_key) is not None
+            if count:
+                self.counts['prompt_hits' if found else 'misses'] += 1
+            if found:
+                self.index['sentences'][content_key(normalize_sentence(sentence))] = {
+                    'prompt': prompt,
+                    'prompt_key': prompt_key,
+                }
+                self._save_index()
+            return found
+
+    def store(self, sentence, prompt, image_path):
+        """
+        Copy a newly generated image into the cache and remember which prompt the sentence was engineered into.
+        """
+        prompt_key = content_key(prompt)
+        filename = prompt_key + os.path.splitext(image_path)[1]
+        with self.lock:
+            if prompt_key not in self.index['images']:
+                shutil.copyfile(image_path, os.path.join(self.directory, filename))
+                self.index['images'][prompt_key] = {
+                    'file': filename,
+                    'size': os.path.getsize(image_path),
+                    'last_used': time.time(),
+                }
+            self.index['sentences'][content_key(normalize_sentence(sentence))] = {
+                'prompt': prompt,
+                'prompt_key': prompt_key,
+            }
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        images = self.index['images']
+        total_bytes = sum(entry['size'] for entry in images.values())
+        for prompt_key in sorted(images, key=lambda key: images[key]['last_used']):
+            if total_bytes <= self.max_bytes:
+                break
+            entry = images.pop(prompt_key)
+            total_bytes -= entry['size']
+            path = os.path.join(self.directory, entry['file'])
+            if os.path.exists(path):
+                os.remove(path)
+
+        # Forget sentences whose image was evicted
+        self.index['sentences'] = {
+            key: entry for key, entry in self.index['sentences'].items() if entry['prompt_key'] in images
+        }
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def stats(self):
+        with self.lock:
+            requests = sum(self.counts.values())
+            hits = self.counts['sentence_hits'] + self.counts['prompt_hits']
+            return {
+                **self.counts,
+                'hit_rate': hits / requests if requests else 0.0,
+                'images': len(self.index['images']),
+                'bytes': sum(entry['size'] for entry in self.index['images'].values()),
+            }
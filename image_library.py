@@ -0,0 +1,233 @@
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from artifacts import file_hash
+from sklearn.preprocessing import normalize
+from context_clustering import get_sentence_model
+
+# Local library of approved images (past outputs and curated pictograms), indexed by the embedding
+# of the sentence each image illustrates. A new sentence close enough to a stored one reuses its image,
+# so only sentences with no similar approved image go to DALL-E.
+
+LIBRARY_DIR = "app/static/image_library"
+# Minimum cosine similarity between sentence embeddings for an image to be reused
+SIMILARITY_THRESHOLD = 0.8
+# Whether newly generated images are approved for reuse straight away. They are not by default, and are
+# only reused once approved (python image_library.py approve).
+AUTO_APPROVE_GENERATED = False
+# Curated pictogram folders contain the images and a manifest mapping each filename to the sentence it illustrates
+CURATED_MANIFEST = "pictograms.json"
+
+
+class ImageLibrary:
+    """
+    Sentence-embedding index over approved images. Lookups are one matrix-vector product
+    over the stored embeddings. Safe to use from several threads.
+
+    Embeddings are appended to a raw float32 file, and index.json (the entries and the embedding size)
+    is replaced atomically after each append, so an interrupted add leaves at most trailing embeddings
+    without entries, which are dropped on load.
+    """
+
+    def __init__(self, directory=LIBRARY_DIR, threshold=SIMILARITY_THRESHOLD, model_name='all-MiniLM-L6-v2'):
+        self.directory = directory
+        self.threshold = threshold
+        self.model_name = model_name
+        self.index_path = os.path.join(directory, "index.json")
+        self.embeddings_path = os.path.join(directory, "embeddings.f32")
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # entries[i] describes the image whose sentence embedding is row i of self.embeddings
+        self.entries = []
+        self.embeddings = None
+        try:
+            self._load()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: Could not read the image library, starting empty. Error: {e}")
+            self.entries, self.embeddings = [], None
+        self.approved = np.array([entry['approved'] for entry in self.entries], dtype=bool)
+        # (sentence, image content hash) of every entry, so the same image is never added twice for a sentence
+        self.keys = {(entry['sentence'], entry['hash']) for entry in self.entries}
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+
+        if isinstance(index, list):
+            # Library written by an earlier version, with its embeddings in embeddings.npy
+            self.entries = index
+            for entry in self.entries:
+                entry.setdefault('hash', file_hash(os.path.join(self.directory, entry['file'])))
+            self.embeddings = np.load(os.path.join(self.directory, "embeddings.npy")).astype(np.float32)
+            self.embeddings.tofile(self.embeddings_path)
+            self._save_index()
+            return
+
+        entries, dim = index['entries'], index['dim']
+        embeddings = np.fromfile(self.embeddings_path, dtype=np.float32) if os.path.exists(self.embeddings_path) else np.empty(0, np.float32)
+        rows = min(len(entries), embeddings.size // dim)
+        if embeddings.size > rows * dim:
+            # Embeddings of an add interrupted before its entries were saved; the next add overwrites them
+            os.truncate(self.embeddings_path, rows * dim * embeddings.itemsize)
+        self.entries = entries[:rows]
+        self.embeddings = embeddings[:rows * dim].reshape(rows, dim) if rows else None
+
+    def embed(self, sentences):
+        return normalize(get_sentence_model(self.model_name).encode(sentences)).astype(np.float32)
+
+    def lookup_many(self, sentences, count=True):
+        """
+        Find the most similar approved image for each sentence.
+        Lookups made ahead of the request, such as prefetching, pass count=False.
+
+        Returns:
+        - List with, for each sentence, (image path, similarity) if an approved image is within the threshold, else None.
+        """
+        if not sentences:
+            return []
+        with self.lock:
+            if self.embeddings is None or not self.approved.any():
+                if count:
+                    self.counts['misses'] += len(sentences)
+                return [None] * len(sentences)
+            embeddings, entries = self.embeddings[self.approved], [e for e, a in zip(self.entries, self.approved) if a]
+
+        similarity = self.embed(sentences) @ embeddings.T
+        best = similarity.argmax(axis=1)
+
+        matches = []
+        for i, j in enumerate(best):
+            if similarity[i, j] >= self.threshold:
+                matches.append((os.path.join(self.directory, entries[j]['file']), float(similarity[i, j])))
+            else:
+                matches.append(None)
+
+        if count:
+            with self.lock:
+                hits = sum(match is not None for match in matches)
+                self.counts['hits'] += hits
+                self.counts['misses'] += len(matches) - hits
+        return matches
+
+    def add(self, sentence, image_path, approved=AUTO_APPROVE_GENERATED, source='generated'):
+        """
+        Copy an image into the library and index it under the sentence it illustrates.
+        """
+        self.add_many([(sentence, image_path)], approved, source)
+
+    def add_many(self, items, approved=AUTO_APPROVE_GENERATED, source='generated'):
+        """
+        Copy (sentence, image path) pairs into the library, embedding their sentences in one batch.
+        An image already stored for the same sentence is not added again, and is approved if `approved`.
+        Returns the number of images added.
+        """
+        hashed = [(sentence, image_path, file_hash(image_path)) for sentence, image_path in items]
+        with self.lock:
+            new = []
+            for sentence, image_path, digest in hashed:
+                if (sentence, digest) in self.keys:
+                    if approved:
+                        self._approve([i for i, entry in enumerate(self.entries)
+                                       if (entry['sentence'], entry['hash']) == (sentence, digest)])
+                    continue
+                self.keys.add((sentence, digest))
+                new.append((sentence, image_path, digest))
+        if not new:
+            return 0
+
+        embeddings = self.embed([sentence for sentence, _, _ in new])
+        with self.lock:
+            for sentence, image_path, digest in new:
+                # Files are named by content, so an image illustrating several sentences is stored once
+                filename = f"{digest}{os.path.splitext(image_path)[1]}"
+                if not os.path.exists(os.path.join(self.directory, filename)):
+                    shutil.copyfile(image_path, os.path.join(self.directory, filename))
+                self.entries.append({'sentence': sentence, 'file': filename, 'hash': digest,
+                                     'approved': approved, 'source': source})
+            with open(self.embeddings_path, 'ab') as f:
+                embeddings.tofile(f)
+            self.embeddings = embeddings if self.embeddings is None else np.vstack([self.embeddings, embeddings])
+            self.approved = np.append(self.approved, [approved] * len(new))
+            self._save_index()
+        return len(new)
+
+    def add_curated(self, directory):
+        """
+        Add a folder of curated pictograms described by its CURATED_MANIFEST, approved for reuse.
+        Returns the number of pictograms added.
+        """
+        with open(os.path.join(directory, CURATED_MANIFEST), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        items = [(sentence, os.path.join(directory, filename)) for filename, sentence in manifest.items()]
+        return self.add_many(items, approved=True, source='curated')
+
+    def pending(self):
+        """
+        Returns (entry index, entry) of every image waiting for approval.
+        """
+        with self.lock:
+            return [(i, entry) for i, entry in enumerate(self.entries) if not entry['approved']]
+
+    def approve(self, indices):
+        """
+        Approve the images at the given entry indices for reuse.
+        """
+        with self.lock:
+            self._approve(indices)
+
+    def _approve(self, indices):
+        indices = [i for i in indices if not self.entries[i]['approved']]
+        if not indices:
+            return
+        for i in indices:
+            self.entries[i]['approved'] = True
+            self.approved[i] = True
+        self._save_index()
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        dim = self.embeddings.shape[1] if self.embeddings is not None else 0
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dim': dim, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts['hits'] + self.counts['misses']
+            return {
+                **self.counts,
+                'hit_rate': self.counts['hits'] / lookups if lookups else 0.0,
+                'images': len(self.entries),
+                'approved': int(self.approved.sum()),
+            }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the library of images reused for similar sentences.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('pending', help="List generated images waiting for approval")
+    approve_parser = commands.add_parser('approve', help="Approve images for reuse by their index")
+    approve_parser.add_argument('indices', nargs='+', type=int)
+    curated_parser = commands.add_parser('add-curated', help=f"Add a folder of pictograms described by its {CURATED_MANIFEST}")
+    curated_parser.add_argument('directory')
+    args = parser.parse_args()
+
+    library = ImageLibrary()
+    if args.command == 'pending':
+        for i, entry in library.pending():
+            print(f"{i}\t{os.path.join(library.directory, entry['file'])}\t{entry['sentence']}")
+    elif args.command == 'approve':
+        library.approve(args.indices)
+        print(f"Approved {len(args.indices)} images")
+    else:
+        print(f"Added {library.add_curated(args.directory)} pictograms from {args.directory}")
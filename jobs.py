@@ -0,0 +1,36 @@
+import threading
+
+# Cooperative cancellation for document processing jobs. A job passes its CancelToken down to
+# summarise, translate and generate_images_from_prompts, which check it before issuing each new
+# API request. Cancelling a job therefore stops new requests and drops queued ones; a request
+# already in flight is allowed to finish, but its result is discarded.
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def wait(self, timeout):
+        # Sleep up to `timeout` seconds, waking as soon as the job is cancelled. Returns whether it was.
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise JobCancelled()
+
+
+def raise_if_cancelled(cancel_token):
+    # Helper for functions where the token is optional
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
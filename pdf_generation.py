@@ -1,5 +1,15 @@
 import fitz
+import hashlib
 import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import lru_cache
+from io import BytesIO
+from PIL import Image
+from document_model import Pagination
+from artifacts import content_hash, prune_artifacts, write_artifact
 
 # Image and font size for Body(14 for Easy Read)
 IMAGE_SIZE = (100,100)
@@ -12,6 +22,40 @@ MARGIN_BOTTOM = 50
 MARGIN_SIDES = 40
 MINIMUM_VERTICAL_MARGIN = 10
 
+# Images are embedded at the resolution of their slot at this DPI rather than at their full 512x512
+SLOT_IMAGE_DPI = 200
+SLOT_IMAGE_QUALITY = 85
+
+# Page images shown in the editor. RENDER_FORMAT is "jpeg", "png" or "webp".
+RENDER_DPI = 200
+RENDER_FORMAT = "jpeg"
+RENDER_QUALITY = 85
+RENDER_WORKERS = os.cpu_count() or 1
+# Documents shorter than this are rendered in-process, where starting worker processes costs more than it saves
+MIN_PARALLEL_PAGES = 8
+# Low-resolution previews rendered first, shown until the full-resolution pages are ready
+RENDER_PREVIEW = True
+PREVIEW_DPI = 50
+IMAGE_EXTENSIONS = {"jpeg": "jpg", "png": "png", "webp": "webp"}
+
+# Options for serializing generated PDFs: drop unused objects, merge duplicate ones (so identical
+# images are stored once), compress every stream and pack objects into compressed object streams
+PDF_SAVE_OPTIONS = {'garbage': 4, 'deflate': True, 'deflate_images': True, 'deflate_fonts': True, 'use_objstms': 1}
+# Images shown above this DPI, such as a full-size letterhead in a template, are resampled to SLOT_IMAGE_DPI.
+# This is done once when a template is opened, so every document built on it embeds the smaller images.
+OPTIMIZE_DPI_THRESHOLD = 300
+OPTIMIZE_TEMPLATE_IMAGES = True
+
+# Opened template PDFs by path, with the modification time and size of the file they were opened from
+template_cache = {}
+template_lock = threading.Lock()
+
+# Number of group layouts kept for reuse across fitting, drawing and regenerated documents
+LAYOUT_CACHE_SIZE = 4096
+
+# Measured layout of a group's text: its wrapped lines and the height of the group
+GroupLayout = namedtuple('GroupLayout', ['lines', 'height'])
+
 def measure_text_width(text, font_size):
     font = fitz.Font(FONT_NAME)
     text_width = font.text_length(text,font_size)
@@ -84,17 +128,134 @@ def calculate_group_height(page, group_text):
     group_height = max(image_height, text_height)
     return group_height
 
+@lru_cache(maxsize=None)
+def get_font(font_name=FONT_NAME):
+    # Font metrics are loaded once per font instead of once per measured string
+    return fitz.Font(font_name)
+
+@lru_cache(maxsize=65536)
+def word_width(word, font_size, font_name=FONT_NAME):
+    return get_font(font_name).text_length(word, font_size)
+
+def break_lines(text, max_width, font_size=BODY_FONT_SIZE, font_name=FONT_NAME):
+    """
+    Break text into lines no wider than max_width, from cached word widths.
+
+    A line's width is accumulated word by word (the width of a line is the sum of its word and
+    space widths), so each word is measured once instead of re-measuring the growing line.
+    Produces the same lines as the wrapping in calculate_group_height, including a '\n' line for
+    each blank line and words wider than max_width on lines of their own.
+
+    Returns:
+    - List of lines.
+    """
+    space_width = word_width(" ", font_size, font_name)
+    lines = []
+    current_line = ""
+    current_width = 0.0
+    for part in text.splitlines(keepends=True):
+        words = part.split()
+        # Parts ending in a line break other than "\n" (such as "\r") run on into the next part
+        ends_line = "\n" in part
+        if ends_line and not words:
+            current_line = '\n'
+        for word in words:
+            width = word_width(word, font_size, font_name)
+            test_width = current_width + space_width + width if current_line else width
+            if test_width <= max_width:
+                current_line = f"{current_line} {word}" if current_line else word
+                current_width = test_width
+            else:
+                if current_line:
+                    lines.append(current_line)
+                current_line = word
+                current_width = width
+        if ends_line and current_line:
+            lines.append(current_line)
+            current_line = ""
+            current_width = 0.0
+
+    if current_line:
+        lines.append(current_line)
+    return lines
+
+@lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def plan_group(group_text, max_text_width, font_size=BODY_FONT_SIZE, font_name=FONT_NAME):
+    """
+    Layout of a group's text in a column of max_text_width, with lines broken by break_lines.
+    Layouts are cached by text, width, font size and font, so a group is measured once however
+    often it is fitted, drawn or regenerated, and an edited group is simply measured under its new text.
+    """
+    lines = tuple(break_lines(group_text, max_text_width, font_size, font_name))
+    line_height = font_size * 1.5  # 1.5 factor for line spacing
+    # Group height is the maximum of image height and text height
+    return GroupLayout(lines, max(IMAGE_SIZE[1], len(lines) * line_height))
+
+def text_width(page):
+    # Width of the text column, right of the group image
+    return page.rect.width - 2*MARGIN_SIDES - IMAGE_SIZE[0] - 10
+
+def group_height(page, group_text):
+    """
+    Height of a group, as calculate_group_height, from its cached layout.
+    """
+    return plan_group(group_text, text_width(page)).height
+
+def layout_stats():
+    info = plan_group.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'hit_rate': info.hits / lookups if lookups else 0.0,
+        'layouts': info.currsize,
+    }
+
+@lru_cache(maxsize=256)
+def slot_image(image_path, mtime, slot_size):
+    """
+    JPEG bytes of the image downscaled to fill a slot of `slot_size` points at SLOT_IMAGE_DPI.
+    `mtime` is part of the cache key, so an image rewritten by a later job is resized again.
+    """
+    pixels = tuple(round(side * SLOT_IMAGE_DPI / 72) for side in slot_size)
+    img = Image.open(image_path)
+    img.draft("RGB", pixels)
+    img = img.convert("RGB")
+    if img.size[0] > pixels[0] or img.size[1] > pixels[1]:
+        img = img.resize(pixels, Image.LANCZOS, reducing_gap=2.0)
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=SLOT_IMAGE_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+def insert_slot_image(page, rect, image_path, image_xrefs):
+    """
+    Insert the slot-sized derivative of an image. An image already in the document, recorded in
+    `image_xrefs` by content hash, is referenced by its xref instead of being embedded again.
+    Section images are copies, so the same picture can appear under several paths.
+    """
+    stream = slot_image(image_path, os.path.getmtime(image_path), IMAGE_SIZE)
+    key = hashlib.sha1(stream).hexdigest()
+    if image_xrefs is not None and key in image_xrefs:
+        page.insert_image(rect, xref=image_xrefs[key])
+        return
+    xref = page.insert_image(rect, stream=stream)
+    if image_xrefs is not None:
+        image_xrefs[key] = xref
+
 # Function to add groups with dynamic spacing
-def add_groups(page, groups, num_groups, max_height):
+def add_groups(page, groups, num_groups, max_height, image_xrefs=None, text_rects=None):
     total_group_height = 0
     n = 0
+    # Layouts measured while fitting are reused for drawing
+    layouts = []
     for i in range(len(groups)):
         tmp_image, tmp_text = groups[i]
-        tmp_height = calculate_group_height(page,tmp_text)
-        if total_group_height + tmp_height > (max_height) :
+        layout = plan_group(tmp_text, text_width(page))
+        if total_group_height + layout.height > (max_height) :
             break
         else:
-            total_group_height += tmp_height
+            total_group_height += layout.height
+            layouts.append(layout)
             n += 1
     n = min(n, num_groups)
     vertical_margin = (max_height - total_group_height) / n
@@ -107,18 +268,21 @@ def add_groups(page, groups, num_groups, max_height):
         group_image, group_text = groups[i]
 
         # Insert group image and text
-        page.insert_image(fitz.Rect(MARGIN_SIDES, y_position, MARGIN_SIDES + IMAGE_SIZE[0], y_position + IMAGE_SIZE[1]), 
-                          filename=group_image)  # Adjust width/height as needed
+        insert_slot_image(page, fitz.Rect(MARGIN_SIDES, y_position, MARGIN_SIDES + IMAGE_SIZE[0], y_position + IMAGE_SIZE[1]),
+                          group_image, image_xrefs)
         text_x = MARGIN_SIDES + IMAGE_SIZE[0] + 10  # 10 units padding on left
         text_y = y_position
-        group_height = calculate_group_height(page, group_text)
+        text_height = layouts[i].height
+        text_rect = fitz.Rect(
+            text_x,
+            text_y,
+            page.rect.width - MARGIN_SIDES,
+            text_y + text_height + 5 # 5 units padding at bottom
+        )
+        if text_rects is not None:
+            text_rects.append(tuple(text_rect))
         page.insert_textbox(
-            fitz.Rect(
-                text_x,
-                text_y,
-                page.rect.width - MARGIN_SIDES,
-                text_y + group_height + 5 # 5 units padding at bottom
-            ),
+            text_rect,
             group_text,
             fontname=FONT_NAME,
             fontsize=BODY_FONT_SIZE,
@@ -126,147 +290,313 @@ def add_groups(page, groups, num_groups, max_height):
             color=(0, 0, 0),
             overlay=True
         )
-        y_position += group_height + vertical_margin
+        y_position += text_height + vertical_margin
     # Return number of groups added
     return n
 
 # Generate PDF based on specified group count per page
-def generate_pdf(output_path, template_pdf, all_groups, groups_per_page):
-    try:
-        # Try opening the template PDF
-        template_pdf = fitz.open(template_pdf)
+def open_template(template_path):
+    """
+    Returns the opened template PDF and the size of its first page.
+    Templates are opened once and shared by every document built on them until the file changes.
+    Raises an exception if the template cannot be opened.
+    """
+    stat = os.stat(template_path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with template_lock:
+        cached = template_cache.get(template_path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        template_pdf = fitz.open(template_path)
+        if OPTIMIZE_TEMPLATE_IMAGES:
+            optimize_template(template_pdf)
         # Get the first page of the template
         template_page = template_pdf[0]
-        page_width, page_height = template_page.rect.width, template_page.rect.height
+        template = (template_pdf, template_page.rect.width, template_page.rect.height)
+        if cached is not None:
+            cached[1][0].close()
+        template_cache[template_path] = (version, template)
+        return template
+
+def build_pdf(template_pdf, all_groups, groups_per_page):
+    """
+    Lay out the groups on pages stamped with the template, up to `groups_per_page` per page.
+    Returns the document in memory, for counting, rendering and saving without re-reading it,
+    the number of groups that fitted on each page and the rectangle of each group's text.
+    """
+    try:
+        # Try opening the template PDF
+        template_pdf, page_width, page_height = open_template(template_pdf)
     except Exception as e:
         # If the template can't be opened, define a default page size
         print(f"Warning: Could not open template PDF. Using default page size. Error: {e}")
+        template_pdf = None
         page_width, page_height = 595, 842  # Default size: A4 (in points, 72 points per inch)
 
     doc = fitz.open()
+    page_counts = []
+    text_rects = []
+    # Images already embedded in this document, by content hash, so repeated images share one image object
+    image_xrefs = {}
     i = 0
 
     while i < len(all_groups):
         new_page = doc.new_page(width=page_width, height=page_height)
         
-        if 'template_page' in locals():
-            # If the template was loaded, copy its content
+        if template_pdf is not None:
+            # If the template was loaded, copy its content. The first page grafts the template into the
+            # document as a form XObject, which the following pages reference.
             new_page.show_pdf_page(new_page.rect, template_pdf, 0)
 
         # Add the maximum possible number of groups (up to `groups_per_page`) that can fit in the available space.
         max_height = page_height - MARGIN_TOP - MARGIN_BOTTOM - MINIMUM_VERTICAL_MARGIN * (groups_per_page - 1)
-        n = add_groups(new_page, all_groups[i:i + groups_per_page], groups_per_page, max_height)
+        n = add_groups(new_page, all_groups[i:i + groups_per_page], groups_per_page, max_height, image_xrefs, text_rects)
 
         # Advance the group index by the number of groups placed on this page
         i += n
+        page_counts.append(n)
 
-    # Ensure the output directory exists
-    output_dir = os.path.dirname(output_path)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    return doc, page_counts, text_rects
 
-    # Save the document
-    doc.save(output_path)
-    doc.close()
+def optimize_template(template_pdf):
+    """
+    Recompress the images an opened template shows above OPTIMIZE_DPI_THRESHOLD at slot resolution.
+    Only the document in memory changes, not the template file. Skipped if this PyMuPDF version
+    lacks it or it fails, since the template is usable as it is.
+    """
+    if hasattr(template_pdf, 'rewrite_images'):
+        try:
+            template_pdf.rewrite_images(dpi_threshold=OPTIMIZE_DPI_THRESHOLD, dpi_target=SLOT_IMAGE_DPI, quality=SLOT_IMAGE_QUALITY)
+        except Exception as e:
+            print(f"Warning: Could not recompress the template's images. Error: {e}")
+
+def optimize_pdf(doc):
+    """
+    Shrink a document before it is saved by subsetting its embedded fonts to the glyphs used.
+    Skipped if it fails, since the document is complete without it.
+    """
+    try:
+        doc.subset_fonts()
+    except Exception as e:
+        print(f"Warning: Could not subset the PDF's fonts. Error: {e}")
+
+def source_size(template_path, all_groups):
+    """
+    Bytes of the template file and of each distinct image file of the groups: roughly what a
+    document embedding them as they are would take, without serializing it to find out.
+    """
+    paths = {template_path} | {image for image, _ in all_groups}
+    return sum(os.path.getsize(path) for path in paths if path and os.path.isfile(path))
+
+def pdf_bytes(doc, original_size=None):
+    """
+    Optimize a document and serialize it with PDF_SAVE_OPTIONS, reporting its size and the time taken,
+    and the size it was reduced from if `original_size` (such as source_size) is given.
+    """
+    start = time.perf_counter()
+    optimize_pdf(doc)
+    data = doc.tobytes(**PDF_SAVE_OPTIONS)
+    before = f"{original_size / 1024:.0f}KB of template and images -> " if original_size is not None else ""
+    print(f"Saved PDF: {len(doc)} pages, {before}{len(data) / 1024:.0f}KB "
+          f"in {1000 * (time.perf_counter() - start):.0f}ms")
+    return data
 
 # Constants for PDF processing
-PDF_PATH = "app/static/pdf/output.pdf"
 TEMPLATE_PATH = "app/static/uploads/template.pdf"
 OUTPUT_DIR = "app/static/pdf2image"
 
-def compile_info_for_pdf(text: list, image_paths: list[tuple[str, str]], template: int = 3, temp_path: str = None):
-    TEMPLATE_PATH = "app/static/uploads/template.pdf"
-    if temp_path is not None:
-        TEMPLATE_PATH = temp_path
-    all_groups = []
-    for i in range(len(text)):
-        all_groups.append([image_paths[i][1], text[i]])
-        
-    # Generate the PDF with the sample data
-    generate_pdf(PDF_PATH, TEMPLATE_PATH, all_groups, template)
-    generate_all_images(PDF_PATH, OUTPUT_DIR)
-    TOTAL_PAGES = get_page_count(PDF_PATH)
-    page_text_boxes = populate_text_boxes(TOTAL_PAGES, text, template)
-    
-    # Create a mapping between `page_text_boxes` and `all_groups`
-    mapping = {}
-
-    # Initialize mapping in order
-    list_index = 0
-    for page, boxes in page_text_boxes.items():
-        for box in boxes.keys():
-            if list_index < len(all_groups):
-                mapping[(page, box)] = list_index
-                list_index += 1
-    
-    
-    return TOTAL_PAGES, page_text_boxes, all_groups, mapping
-        
-def caller(text, template, temp_path):
-    TEMPLATE_PATH = "app/static/uploads/template.pdf"
-    if temp_path is not None:
-        TEMPLATE_PATH = temp_path
-    generate_pdf(PDF_PATH, TEMPLATE_PATH, text, template)
-    generate_all_images(PDF_PATH, OUTPUT_DIR)
-    TOTAL_PAGES = get_page_count(PDF_PATH)
-    
-    temp = []
-    for i in text:
-        temp.append(i[1])
-    page_text_boxes = populate_text_boxes(TOTAL_PAGES, temp, template)
-    
-    return TOTAL_PAGES, page_text_boxes
-    
-# Function to update text in both dictionary and list
-def update_text(l, d, map, page, box, new_text):
-    # Update the dictionary
-    if page in d and box in d[page]:
-        d[page][box] = new_text
-        
-        # Update the corresponding list
-        list_index = map.get((page, box))
-        if list_index is not None:
-            l[list_index][1] = new_text
-
-def get_page_count(pdf_file):
-    """
-    Returns the total number of pages in the PDF file.
-    """
-    doc = fitz.open(pdf_file)  # Open the PDF document
-    page_count = len(doc)  # Get the number of pages
-    doc.close()  # Close the document
-    return page_count
-
-def populate_text_boxes(total_pages, results, template):
-    # Initialize the page_text_boxes dictionary with empty dictionaries
-    page_text_boxes = {page: {} for page in range(1, total_pages + 1)}
-    
-    # Use an iterator to assign results to boxes
-    result_iterator = iter(results)
-    
-    # Loop through each page
-    for page in range(1, total_pages + 1):
-        # Assign a maximum of 3 or 4 boxes per page depending on the template
-        for box_num in range(1, template + 1):
-            try:
-                # Assign the next result to the current box
-                text = next(result_iterator)
-                page_text_boxes[page][f"box{box_num}"] = text
-            except StopIteration:
-                # If results are exhausted, return the dictionary
-                return page_text_boxes
-    print(page_text_boxes)
-    return page_text_boxes
+def page_image_name(i, preview=False, image_format=RENDER_FORMAT):
+    return f"pdf_page_{i}{'_preview' if preview else ''}.{IMAGE_EXTENSIONS[image_format]}"
+
+def save_page_image(page, output_dir, filename, dpi, image_format):
+    """
+    Render a page and save it under the content-hashed version of `filename`. Returns the file's name.
+    """
+    pix = page.get_pixmap(dpi=dpi)  # render page to an image
+    if image_format == "png":
+        data = pix.tobytes("png")
+    else:
+        # PyMuPDF cannot write WebP, so lossy formats are encoded by PIL
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        buffer = BytesIO()
+        img.save(buffer, format=image_format.upper(), quality=RENDER_QUALITY)
+        data = buffer.getvalue()
+    return os.path.basename(write_artifact(output_dir, filename, data))
 
-def generate_all_images(pdf_path, output_dir):
+def render_pages(doc, output_dir, dpi=RENDER_DPI, image_format=RENDER_FORMAT, preview=False, pages=None):
     """
-    Converts all pages of the PDF into images and saves them in the output directory.
+    Renders pages of an open document (all of them by default) as images in the output directory.
+    Returns the names of the images, named by content hash, in page order.
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    doc = fitz.open(pdf_path)  # open document
-    for i, page in enumerate(doc):
-        pix = page.get_pixmap(dpi = 200)  # render page to an image
-        output_path = os.path.join(output_dir, f"pdf_page_{i}.jpg")
-        pix.save(output_path)    
\ No newline at end of file
+    return [
+        save_page_image(doc[i], output_dir, page_image_name(i, preview, image_format), dpi, image_format)
+        for i in (range(len(doc)) if pages is None else pages)
+    ]
+
+def render_page_range(pdf_data, pages, output_dir, dpi, image_format):
+    # Runs in a worker process, which opens its own copy of the document
+    doc = fitz.open(stream=pdf_data, filetype="pdf")
+    filenames = render_pages(doc, output_dir, dpi, image_format, pages=pages)
+    doc.close()
+    return filenames
+
+def render_pages_parallel(pdf_data, page_count, output_dir, dpi=RENDER_DPI, image_format=RENDER_FORMAT, max_workers=RENDER_WORKERS):
+    """
+    Renders all pages of a serialized PDF across a process pool, each worker rendering every
+    max_workers-th page so slow pages are spread evenly. Returns the names of the images in page order.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    workers = min(max_workers, page_count)
+    if workers <= 1 or page_count < MIN_PARALLEL_PAGES:
+        return render_page_range(pdf_data, range(page_count), output_dir, dpi, image_format)
+
+    filenames = [None] * page_count
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(render_page_range, pdf_data, range(k, page_count, workers), output_dir, dpi, image_format)
+            for k in range(workers)
+        ]
+        for k, future in enumerate(futures):
+            filenames[k::workers] = future.result()
+    return filenames
+
+
+# Templates (groups per page) whose documents are built ahead of time, so switching between them is instant
+TEMPLATES = (3, 4)
+
+def template_image_dir(template):
+    # Each template has its own page images, so both can be ready at once
+    return os.path.join(OUTPUT_DIR, str(template))
+
+def build_document(all_groups, template, temp_path=None):
+    """
+    Build the PDF of a template. The document is built, counted and serialized in memory,
+    and nothing is written to disk; its pages are rasterized by render_document only when needed.
+
+    Returns:
+    - Dictionary with the page count, the Pagination of the groups as they were actually laid out,
+      the PDF bytes with their content hash, and the directory its page images are rendered to.
+    """
+    template_path = temp_path or TEMPLATE_PATH
+    doc, page_counts, text_rects = build_pdf(template_path, all_groups, template)
+    data = pdf_bytes(doc, source_size(template_path, all_groups))
+    document = {
+        'total_pages': len(doc),
+        'pagination': Pagination(page_counts, text_rects),
+        'pdf_bytes': data,
+        'pdf_hash': content_hash(data),
+        'image_dir': template_image_dir(template),
+    }
+    doc.close()
+    return document
+
+def render_document(document, on_preview=None):
+    """
+    Rasterize the pages of a built document for clients that cannot render the PDF themselves.
+    With RENDER_PREVIEW, low-resolution previews are rendered first and the document is passed to
+    `on_preview` before the full-resolution pages are rendered in parallel.
+
+    Page images are named by content hash, so the pages an edit did not change keep their names
+    (and stay in browsers' caches), and the images of the previous build are removed once done.
+
+    Returns:
+    - The document (see build_document), with the names of its preview and page images and whether
+      the page images are at full resolution.
+    """
+    image_dir, total_pages = document['image_dir'], document['total_pages']
+    preview_images = []
+    if RENDER_PREVIEW:
+        doc = fitz.open(stream=document['pdf_bytes'], filetype="pdf")
+        preview_images = render_pages(doc, image_dir, dpi=PREVIEW_DPI, preview=True)
+        doc.close()
+        if on_preview is not None:
+            on_preview(dict(document, preview_images=preview_images, page_images=None, full_resolution=False))
+
+    start = time.perf_counter()
+    page_images = render_pages_parallel(document['pdf_bytes'], total_pages, image_dir)
+    print(f"Rendered {total_pages} pages at {RENDER_DPI} DPI in {time.perf_counter() - start:.2f}s")
+    prune_artifacts(image_dir, [os.path.join(image_dir, filename) for filename in preview_images + page_images], prefix="pdf_page_")
+    return dict(document, preview_images=preview_images, page_images=page_images, full_resolution=True)
+
+def render_build(build, on_preview=None):
+    # Rasterize the document of a build queued before this render on the same worker
+    return render_document(build.result(), on_preview)
+
+class DocumentBuilds:
+    """
+    The documents of every template in TEMPLATES, built in the background from the same groups.
+    Group layouts are shared between templates through plan_group's cache. Builds and renders run
+    one at a time on a single worker, since PyMuPDF must not be used from several threads at once.
+    With `rasterize`, every build's pages are rendered ahead of time; otherwise a template's pages
+    are only rendered once a client asks for them.
+    """
+
+    def __init__(self, templates=TEMPLATES, rasterize=True):
+        self.templates = templates
+        self.rasterize = rasterize
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        # Future of each template's build, and its render's Future with a Future set once its preview is ready
+        self.builds = {}
+        self.renders = {}
+        self.groups = None
+        self.temp_path = None
+
+    def start(self, groups, temp_path=None, first=None, prebuild=True):
+        """
+        Rebuild every template's document from groups, starting with template `first`.
+        groups must not be edited afterwards: pass EasyReadDocument.snapshot(), so edits made
+        while building only affect the next build. Queued builds and renders of the previous groups are dropped.
+        Without `prebuild`, documents are only built once get asks for them.
+        """
+        order = sorted(set(self.templates) | ({first} if first else set()), key=lambda template: template != first)
+        with self.lock:
+            for build in self.builds.values():
+                build.cancel()
+            for render, _ in self.renders.values():
+                render.cancel()
+            self.groups, self.temp_path = groups, temp_path
+            self.builds, self.renders = {}, {}
+            for template in (order if prebuild else ()):
+                self.builds[template] = self.executor.submit(build_document, groups, template, temp_path)
+                if self.rasterize:
+                    self.renders[template] = self.submit_render(template)
+
+    def submit_render(self, template):
+        # Queued behind the template's build, so the build is done by the time the render starts
+        preview = Future()
+        render = self.executor.submit(render_build, self.builds[template], preview.set_result)
+        return render, preview
+
+    def get(self, template, preview=False, rasterize=False):
+        """
+        Returns the built document of a template (see build_document), waiting for its build if needed,
+        or None if no groups were given yet. With `rasterize`, waits for its page images as well
+        (see render_document), and with `preview` returns as soon as the preview pages are ready.
+        """
+        while True:
+            with self.lock:
+                if self.groups is None:
+                    return None
+                if template not in self.builds:
+                    self.builds[template] = self.executor.submit(build_document, self.groups, template, self.temp_path)
+                if rasterize and template not in self.renders:
+                    self.renders[template] = self.submit_render(template)
+                build = self.builds[template]
+                render, preview_ready = self.renders.get(template, (None, None))
+            try:
+                if not rasterize:
+                    return build.result()
+                done, _ = wait([render, preview_ready] if preview else [render], return_when=FIRST_COMPLETED)
+                if render not in done:
+                    return preview_ready.result()
+                return render.result()
+            except CancelledError:
+                # Superseded by a build of newer groups
+                continue
@@ -26,11 +26,11 @@ def pair_pdfs(directory):
     return paired_list
 
 
-def non_body_filter(block, page_rect):
+def non_body_filter(block, page_rect, side_margin=0.1):
     is_not_header = block['bbox'][1] > page_rect.height * 0.1  # Not in top 10% of page
     is_not_footer = block['bbox'][3] < page_rect.height * 0.9  # Not in bottom 10% of page
-    is_not_side_margin = (block['bbox'][0] > page_rect.width * 0.1 and 
-                          block['bbox'][2] < page_rect.width * 0.9)  # Not in left/right 10% of page
+    is_not_side_margin = (block['bbox'][0] > page_rect.width * side_margin and 
+                          block['bbox'][2] < page_rect.width * (1 - side_margin))  # Not in left/right margins of page
     return all([is_not_header, is_not_footer, is_not_side_margin])
 
 
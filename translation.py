@@ -1,3 +1,4 @@
+import re
 import pandas as pd
 import numpy as np
 from ast import literal_eval
@@ -7,12 +8,15 @@ from openai import OpenAI
 import os
 from dotenv import load_dotenv
 from tqdm import tqdm
-from typing import List, Tuple, Dict, Any, Optional
+from jobs import JobCancelled, raise_if_cancelled
+from api_calls import call_api
+from typing import List, Tuple, Dict, Any, Optional, Callable
 
 
 load_dotenv()
 api_key = os.getenv('API_KEY')
-client = OpenAI(api_key=api_key)
+# Retries are handled by call_api
+client = OpenAI(api_key=api_key, max_retries=0)
 
 
 def split_into_many(tokenizer, text, max_tokens):
@@ -35,13 +39,15 @@ def split_into_many(tokenizer, text, max_tokens):
     return chunks
 
 
-def get_embedding(text, model="text-embedding-ada-002"):
+def get_embedding(text, model="text-embedding-ada-002", cancel_token=None):
     text = text.replace("\n", " ")
-    return client.embeddings.create(input=[text], model=model).data[0].embedding
+    response = call_api('embeddings', lambda timeout: client.embeddings.create(input=[text], model=model, timeout=timeout),
+                        idempotent=True, cancel_token=cancel_token)
+    return response.data[0].embedding
 
 
-def create_context(input, df, max_len=1800, size="ada"):
-    q_embeddings = get_embedding(input)
+def create_context(input, df, max_len=1800, size="ada", cancel_token=None):
+    q_embeddings = get_embedding(input, cancel_token=cancel_token)
     df["distances"] = df["embeddings"].apply(lambda x: cosine(q_embeddings, x))
     returns = []
     cur_len = 0
@@ -73,9 +79,91 @@ def get_refinement_criteria() -> str:
     Ensure the improved version of the translation is wrapped in double quotes."""
 
 
+# Heading of the improved translation in a refinement response, matched case-insensitively
+IMPROVED_VERSION = "improved version"
+# Opening quote of the improved translation: the first character of a line, as save_refinement_history
+# expects, or right after the colon of a heading such as **Improved Version:** "..."
+TRANSLATION_QUOTE = re.compile(r'(?:^|:)[ \t*]*"', re.MULTILINE)
+
+
+def find_translation_start(text: str, marker: int) -> int:
+    """Index of the first character of the improved translation following the IMPROVED_VERSION
+    marker at index `marker`, or -1 until its opening quote has arrived."""
+    quote = TRANSLATION_QUOTE.search(text, marker + len(IMPROVED_VERSION))
+    return -1 if quote is None else quote.end()
+
+
+class SentenceStream:
+    """Incremental parser for a streamed refinement response.
+    The translation is the double-quoted text after the last "improved version", and each of its sentences
+    is passed to `on_sentence` as soon as its period arrives, split as split_into_sentences does."""
+
+    def __init__(self, on_sentence: Callable[[str], None]):
+        self.on_sentence = on_sentence
+        self.text = ""
+        # Index of the last marker received
+        self.marker = -1
+        # Index of the first character of the translation not yet emitted, once its opening quote arrived
+        self.position = None
+        self.closed = False
+
+    def feed(self, delta: str) -> None:
+        self.text += delta
+        # Only the end of the text, where the new delta may have completed a marker, is searched
+        recent = max(0, len(self.text) - len(delta) - len(IMPROVED_VERSION))
+        marker = self.text[recent:].lower().rfind(IMPROVED_VERSION)
+        if marker != -1 and recent + marker > self.marker:
+            # What was parsed after an earlier marker belonged to the critique, so parsing restarts here
+            self.marker, self.position, self.closed = recent + marker, None, False
+        if self.closed or self.marker == -1:
+            return
+        if self.position is None:
+            start = find_translation_start(self.text, self.marker)
+            if start == -1:
+                return
+            self.position = start
+
+        end = self.text.find('"', self.position)
+        while True:
+            period = self.text.find('.', self.position, len(self.text) if end == -1 else end)
+            if period == -1:
+                break
+            sentence = self.text[self.position:period].strip()
+            if sentence:
+                self.on_sentence(sentence + '.')
+            self.position = period + 1
+        # Text after the last period of the translation is never a sentence, as in split_into_sentences
+        self.closed = end != -1
+
+
+def stream_completion(messages: List[Dict[str, str]], model: str, on_sentence: Callable[[str], None],
+                      temperature: float = 0.7, max_tokens: int = 2000, cancel_token=None) -> str:
+    """Request a completion as a stream, passing translation sentences to `on_sentence` as they complete.
+    Returns the full response text. The stream is closed as soon as `cancel_token` is cancelled."""
+    stream = call_api('chat_stream', lambda timeout: client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True,
+        timeout=timeout
+    ), cancel_token=cancel_token)
+    parser = SentenceStream(on_sentence)
+    for chunk in stream:
+        if cancel_token is not None and cancel_token.cancelled:
+            stream.close()
+            raise JobCancelled()
+        if chunk.choices and chunk.choices[0].delta.content:
+            parser.feed(chunk.choices[0].delta.content)
+    return parser.text
+
+
 def refine_translation(client: OpenAI, current_text: str, original_input: str, context: str, 
-                        model: str = "gpt-4-turbo") -> Tuple[str, Dict[str, Any]]:
-    """Refine the given translation based on evaluation criteria."""
+                        model: str = "gpt-4-turbo", on_sentence: Optional[Callable[[str], None]] = None,
+                        cancel_token=None) -> Tuple[str, Dict[str, Any]]:
+    """Refine the given translation based on evaluation criteria.
+    With `on_sentence`, the response is streamed and the sentences of the improved translation
+    are passed to it as soon as each one ends."""
     refinement_prompt = f"""Original Text: {original_input}
 
     Current Translation:
@@ -86,22 +174,30 @@ def refine_translation(client: OpenAI, current_text: str, original_input: str, c
 
     {get_refinement_criteria()}"""
 
+    messages = [
+        {"role": "system", "content": "You are an expert in converting text to easy-read format while maintaining accuracy and clarity."},
+        {"role": "user", "content": refinement_prompt}
+    ]
+
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are an expert in converting text to easy-read format while maintaining accuracy and clarity."},
-                {"role": "user", "content": refinement_prompt}
-            ],
-            temperature=0.7,
-            max_tokens=2000
-        )
-        
-        feedback = response.choices[0].message.content
+        if on_sentence is not None:
+            feedback = stream_completion(messages, model, on_sentence, cancel_token=cancel_token)
+        else:
+            response = call_api('chat', lambda timeout: client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=2000,
+                timeout=timeout
+            ), cancel_token=cancel_token)
+            feedback = response.choices[0].message.content
+
         improved_text = feedback.split("improved version")[-1].strip()
         
         return improved_text, {"full_feedback": feedback}
     
+    except JobCancelled:
+        raise
     except Exception as e:
         print(f"Error in refinement: {str(e)}")
         return current_text, {"error": str(e)}
@@ -183,31 +279,38 @@ def prepare_embeddings_df():
 
 
 def iterative_translation(input_text: str, n_iterations: int = 3, 
-                         model: str = "gpt-4-turbo") -> List[Tuple[str, Dict[str, Any]]]:
+                         model: str = "gpt-4-turbo", cancel_token=None,
+                         on_sentence: Optional[Callable[[str], None]] = None) -> List[Tuple[str, Dict[str, Any]]]:
     # Prepare embeddings DataFrame
     df = prepare_embeddings_df() if not os.path.exists('embeddings.csv') else pd.read_csv('embeddings.csv', index_col=0)
     if 'embeddings' in df.columns:
         df['embeddings'] = df['embeddings'].apply(literal_eval).apply(np.array)
     
     # Get context for the translation
-    context = create_context(input_text, df)
+    raise_if_cancelled(cancel_token)
+    context = create_context(input_text, df, cancel_token=cancel_token)
 
     input_text = "User input: " + input_text + "\nContext: {context}"
     
     # Initial translation
     system_prompt = f"You are a translator, your role is to translate the user input text into easy read format based on BOTH the user input and the context."
     
+    raise_if_cancelled(cancel_token)
     try:
-        response = client.chat.completions.create(
+        # Deterministic (temperature 0), so a hedged duplicate is harmless
+        response = call_api('chat', lambda timeout: client.chat.completions.create(
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": input_text}
             ],
             temperature=0,
             max_tokens=2000,
-            model=model
-        )
+            model=model,
+            timeout=timeout
+        ), idempotent=True, cancel_token=cancel_token)
         current_text = response.choices[0].message.content
+    except JobCancelled:
+        raise
     except Exception as e:
         print(f"Error in initial translation: {str(e)}")
         return []
@@ -216,13 +319,18 @@ def iterative_translation(input_text: str, n_iterations: int = 3,
     
     # Refinement loop
     for i in tqdm(range(n_iterations), desc="Refining translation"):
+        # A cancelled job stops before its next request rather than finishing the loop
+        raise_if_cancelled(cancel_token)
         try:
             refined_text, feedback = refine_translation(
                 client=client,
                 current_text=current_text,
                 original_input=input_text,
                 context=context,
-                model=model
+                model=model,
+                cancel_token=cancel_token,
+                # Only the final pass is streamed, since earlier passes are refined again
+                on_sentence=on_sentence if i == n_iterations - 1 else None
             )
             
             results.append((refined_text, {
@@ -231,6 +339,8 @@ def iterative_translation(input_text: str, n_iterations: int = 3,
             }))
             current_text = refined_text
             
+        except JobCancelled:
+            raise
         except Exception as e:
             print(f"Error in iteration {i+1}: {str(e)}")
             break
@@ -270,9 +380,9 @@ def save_refinement_history(results: List[Tuple[str, Dict[str, Any]]], filename:
     return last_quoted_line
 
 
-def translate(input_text):
-    # Run iterative translation
-    results = iterative_translation(input_text, n_iterations=3)
+def translate(input_text, cancel_token=None, on_sentence=None):
+    # Run iterative translation, streaming the sentences of the final pass to on_sentence if given
+    results = iterative_translation(input_text, n_iterations=3, cancel_token=cancel_token, on_sentence=on_sentence)
     opt = save_refinement_history(results)
 
     return opt